@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+# Benchmark of RuleTrie lookups - compares lookups/sec of the mutable trie
+# (recursive DomainNode lookup) and of the frozen trie.
+#
+# Usage: bench_rule_trie.py rules_dir [rounds]
+#
+# Looked up names are all wildcard-free targets from the rulesets plus their
+# "www." and "nonexistent." prefixed variants, so that both hits and misses
+# are measured.
+
+import sys
+import os
+import glob
+import time
+
+from lxml import etree
+
+from rules import Ruleset
+from rule_trie import RuleTrie
+
+def timeLookups(lookup, fqdns, rounds):
+	"""Return lookups/sec of lookup function over all fqdns."""
+	start = time.time()
+	for i in xrange(rounds):
+		for fqdn in fqdns:
+			lookup(fqdn)
+	elapsed = time.time() - start
+	return len(fqdns) * rounds / elapsed
+
+if __name__ == "__main__":
+	if len(sys.argv) < 2:
+		print >> sys.stderr, "bench_rule_trie.py rules_dir [rounds]"
+		sys.exit(1)
+
+	ruledir = sys.argv[1]
+	rounds = len(sys.argv) > 2 and int(sys.argv[2]) or 3
+
+	trie = RuleTrie()
+	fqdns = []
+	xmlFnames = glob.glob(os.path.join(ruledir, "*.xml"))
+	for xmlFname in xmlFnames:
+		ruleset = Ruleset(etree.parse(file(xmlFname)).getroot(), xmlFname)
+		trie.addRuleset(ruleset)
+		for target in ruleset.uniqueTargetFQDNs():
+			fqdns.extend((target, "www." + target, "nonexistent." + target))
+
+	trie.freeze()
+
+	#both implementations must agree
+	for fqdn in fqdns:
+		if set(trie.root.matchingRulesets(fqdn)) != set(trie.frozenRoot.matchingRulesets(fqdn)):
+			raise RuntimeError("Frozen trie lookup differs for %s" % fqdn)
+
+	print "Rulesets: %d, looked up names: %d, rounds: %d" % (len(xmlFnames), len(fqdns), rounds)
+	mutableRate = timeLookups(trie.root.matchingRulesets, fqdns, rounds)
+	print "Mutable trie: %10.0f lookups/sec" % mutableRate
+	frozenRate = timeLookups(trie.frozenRoot.matchingRulesets, fqdns, rounds)
+	print "Frozen trie:  %10.0f lookups/sec (%.1fx)" % (frozenRate, frozenRate / mutableRate)
@@ -7,15 +7,26 @@ import logging
 import threading
 import Queue
 import time
+import urlparse
+import argparse
+import hashlib
+import signal
 
 from ConfigParser import SafeConfigParser
 
-from lxml import etree
-
 import http_client
 import metrics
-from rules import Ruleset
 from rule_trie import RuleTrie
+from ruleset_cache import loadRulesets
+from state_store import StateStore
+from dns_cache import DNSCache
+from scheduler import HostScheduler, registeredDomain
+from latency import LatencyTracker
+from retry import RetryQueue, classifyError
+from distributed import SharedTaskQueue, TaskLeaser
+from journal import Journal
+from jsonl_sink import JSONLinesSink
+from timing_stats import TimingHistograms
 
 def convertLoglevel(levelString):
 	"""Converts string 'debug', 'info', etc. into corresponding
@@ -44,32 +55,430 @@ def getMetricClass(metricType):
 	return metricMap[metricType]
 
 
+def parseShard(value):
+	"""Parse "i/N" shard specification for argparse.
+	
+	@returns: tuple (i, N)
+	@raises argparse.ArgumentTypeError if the value is malformed
+	"""
+	try:
+		(index, count) = [int(part) for part in value.split("/")]
+	except ValueError:
+		raise argparse.ArgumentTypeError("Shard must be given as i/N, e.g. 0/4")
+	if count < 1 or not 0 <= index < count:
+		raise argparse.ArgumentTypeError("Shard index must be in range 0..N-1")
+	return (index, count)
+
+def rulesetShard(xmlFname, shardCount):
+	"""Return shard (0..shardCount-1) of ruleset file, a stable hash of
+	file's basename, so that all runs partition rulesets the same way.
+	"""
+	digest = hashlib.md5(os.path.basename(xmlFname)).hexdigest()
+	return int(digest[:8], 16) % shardCount
+
+def precompileRulesets(rulesets):
+	"""Compile regexes of all rulesets now rather than on first use.
+	Intended to be run in a background thread.
+	"""
+	startTime = time.time()
+	for ruleset in rulesets:
+		ruleset.precompile()
+	logging.debug("Precompiled %d rulesets in %.2f seconds.", len(rulesets),
+		time.time() - startTime)
+
+def landingPages(ruleset):
+	"""Return list of landing page URLs to test for ruleset's targets.
+	Wildcard targets and excluded pages are skipped.
+	"""
+	pages = []
+	for target in ruleset.uniqueTargetFQDNs():
+		targetHTTPLangingPage = "http://%s/" % target
+		if not ruleset.excludes(targetHTTPLangingPage):
+			pages.append(targetHTTPLangingPage)
+		else:
+			logging.debug("Skipping landing page %s", targetHTTPLangingPage)
+	return pages
+
+def targetRulesets(rulesets):
+	"""Map target FQDNs of rulesets (except wildcard ones) to basenames
+	of ruleset files that declare them.
+	
+	@returns: dict mapping FQDN to list of rule file names
+	"""
+	targets = {}
+	for ruleset in rulesets:
+		for fqdn in ruleset.uniqueTargetFQDNs():
+			targets.setdefault(fqdn, []).append(os.path.basename(ruleset.filename))
+	return targets
+
+def writeDeadTargets(reportFname, targets, dnsCache):
+	"""Report targets that don't exist or couldn't be resolved. Each line
+	of the report has tab-separated FQDN, status ("nxdomain" or
+	"unresolved") and rule file name (more lines if more rule files
+	declare the target). Without report file the targets are logged.
+	
+	@param reportFname: path to report file, "-" for stdout, None to
+	only log the targets
+	@param targets: dict from targetRulesets()
+	@param dnsCache: DNSCache the targets were resolved with
+	@returns: number of non-existent targets
+	"""
+	lines = []
+	deadCount = 0
+	for (fqdn, ruleFnames) in targets.iteritems():
+		if dnsCache.isDead(fqdn):
+			status = "nxdomain"
+			deadCount += 1
+		elif dnsCache.failure(fqdn):
+			status = "unresolved"
+		else:
+			continue
+		for ruleFname in ruleFnames:
+			lines.append((ruleFname, fqdn, status))
+	lines.sort()
+	
+	if reportFname is None:
+		for (ruleFname, fqdn, status) in lines:
+			logging.warn("Target %s is %s. Rulefile: %s", fqdn, status, ruleFname)
+		return deadCount
+	
+	report = reportFname == "-" and sys.stdout or open(reportFname, "w")
+	try:
+		for (ruleFname, fqdn, status) in lines:
+			report.write("%s\t%s\t%s\n" % (fqdn, status, ruleFname))
+	finally:
+		if report is not sys.stdout:
+			report.close()
+	return deadCount
+
+def createTask(plainUrl, trie, fetcherMap, fetcherPlain):
+	"""Rewrite plain URL and create ComparisonTask for it.
+	
+	@param plainUrl: URL to rewrite
+	@param trie: RuleTrie used for rewriting
+	@param fetcherMap: maps ruleset platform to HTTPFetcher for rewritten URL
+	@param fetcherPlain: HTTPFetcher for plain URL
+	@returns: ComparisonTask or None if URL is not rewritten or rewrite failed
+	"""
+	try:
+		ruleFname = None
+		ruleMatch = trie.transformUrl(plainUrl)
+		transformedUrl = ruleMatch.url
+		
+		if plainUrl == transformedUrl:
+			logging.info("Identical URL: %s", plainUrl)
+			return None
+		
+		#URL was transformed, thus ruleset must exist that did it
+		ruleFname = os.path.basename(ruleMatch.ruleset.filename)
+		fetcher = fetcherMap.get(ruleMatch.ruleset.platform)
+		if not fetcher:
+			logging.warn("Unknown platform '%s', using 'default' instead. Rulefile: %s.",
+				ruleMatch.ruleset.platform, ruleFname)
+			fetcher = fetcherMap["default"]
+			
+	except:
+		logging.exception("Failed to transform plain URL %s. Rulefile: %s.",
+			plainUrl, ruleFname)
+		return None
+	
+	return ComparisonTask(plainUrl, transformedUrl, fetcherPlain, fetcher, ruleFname,
+		ruleMatch.ruleset.digest)
+
+def taskGroupKey(task, dnsCache):
+	"""Return key grouping tasks whose plain pages are likely served by the
+	same origin - first resolved IP address of plain URL's host if known,
+	otherwise approximate registered domain of the host.
+	
+	@param task: ComparisonTask
+	@param dnsCache: DNSCache with resolved hosts or None
+	"""
+	host = urlparse.urlparse(task.plainUrl).hostname or ""
+	if dnsCache:
+		addresses = dnsCache.lookup(host)
+		if addresses:
+			return addresses[0]
+	return registeredDomain(host)
+
+class TaskProducer(object):
+	"""Creates ComparisonTasks for plain URLs and puts them into the task
+	queue, unless there's nothing to test.
+	"""
+	
+	def __init__(self, taskQueue, trie, fetcherMap, fetcherPlain):
+		"""
+		@param taskQueue: scheduler.HostScheduler for ComparisonTask objects
+		@see createTask() for description of other parameters
+		"""
+		self.taskQueue = taskQueue
+		self.trie = trie
+		self.fetcherMap = fetcherMap
+		self.fetcherPlain = fetcherPlain
+		#if set, URL pairs checked less than stateTTL seconds ago with
+		#same ruleset version are skipped
+		self.stateStore = None
+		self.stateTTL = None
+		#if set, pages of hosts known not to exist are skipped
+		self.dnsCache = None
+		#if set, URL pairs completed by resumed run are skipped
+		self.journal = None
+		self.queuedCount = 0
+		self.freshCount = 0
+		self.deadCount = 0
+		self.journaledCount = 0
+		#maps plain URLs to transformed URLs of their tasks (None if
+		#there was no task)
+		self.rewrites = {}
+		#maps plain URLs to their queued tasks
+		self.queuedTasks = {}
+	
+	def queue(self, plainUrl):
+		"""Create task for plain URL using current state of the trie and
+		queue it.
+		
+		@returns: the task or None if there's nothing to test
+		"""
+		task = createTask(plainUrl, self.trie, self.fetcherMap, self.fetcherPlain)
+		self.rewrites[plainUrl] = task and task.transformedUrl
+		previous = self.queuedTasks.pop(plainUrl, None)
+		if previous:
+			previous.superseded = True
+		if not task:
+			return None
+		
+		if self.journal and self.journal.isCompleted(task.plainUrl, task.transformedUrl):
+			logging.debug("Skipping %s -> %s, completed before resume.",
+				task.plainUrl, task.transformedUrl)
+			self.journaledCount += 1
+			return None
+		
+		if self.dnsCache:
+			plainHost = urlparse.urlparse(task.plainUrl).hostname
+			if self.dnsCache.isDead(plainHost):
+				logging.error("Non-existent domain %s, skipping %s. Rulefile: %s",
+					plainHost, task.plainUrl, task.ruleFname)
+				self.deadCount += 1
+				return None
+			#rewritten host is often different (e.g. www. prefix)
+			self.dnsCache.prefetch([urlparse.urlparse(task.transformedUrl).hostname])
+		
+		if self.stateStore and self.stateStore.isFresh(task.plainUrl,
+				task.transformedUrl, task.rulesetDigest, self.stateTTL):
+			logging.debug("Skipping %s -> %s, checked recently with same ruleset.",
+				task.plainUrl, task.transformedUrl)
+			self.freshCount += 1
+			return None
+		
+		self.queuedCount += 1
+		self.queuedTasks[plainUrl] = task
+		self.taskQueue.put(task)
+		return task
+
 class ComparisonTask(object):
 	"""Container for objects necessary for one plain/rewritten URL comparison.
 	"""
 	
-	def __init__(self, plainUrl, transformedUrl, fetcherPlain, fetcherRewriting, ruleFname):
+	def __init__(self, plainUrl, transformedUrl, fetcherPlain, fetcherRewriting, ruleFname,
+			rulesetDigest=None):
 		self.plainUrl = plainUrl
 		self.transformedUrl = transformedUrl
 		self.fetcherPlain = fetcherPlain
 		self.fetcherRewriting = fetcherRewriting
 		self.ruleFname = ruleFname
+		self.rulesetDigest = rulesetDigest
+		#number of attempts to compare the pages, incremented on retry
+		self.attempts = 1
+		#set when the page was queued again with different rewrite (see
+		#reconciliation of streamed tasks), result of this task is dropped
+		self.superseded = False
+	
+class ComparisonResult(object):
+	"""Outcome of one ComparisonTask, passed to result sinks (objects with
+	record(result) method, e.g. state_store.StateStore).
+	"""
+	
+	#values of status
+	OK = "ok"
+	BIG_DISTANCE = "big_distance"
+	NON_2XX = "non_2xx"
+	TRUNCATED = "truncated"
+	ERROR = "error"
+	
+	def __init__(self, task, status, plainRcode=None, transformedRcode=None,
+			distance=None, errorStr=None, errorClass=None):
+		"""
+		@param task: ComparisonTask the result is for
+		@param status: one of the status values above
+		@param plainRcode: HTTP code of plain page
+		@param transformedRcode: HTTP code of rewritten page
+		@param distance: distance of the pages as float
+		@param errorStr: description of error for ERROR status
+		@param errorClass: class of error for ERROR status, see
+		retry.classifyError()
+		"""
+		self.task = task
+		self.status = status
+		self.plainRcode = plainRcode
+		self.transformedRcode = transformedRcode
+		self.distance = distance
+		self.errorStr = errorStr
+		self.errorClass = errorClass
+		self.attempts = task.attempts
+		#redirect chains of plain and rewritten page, lists of (URL, HTTP
+		#code, timings) tuples, set if the pages were fetched
+		self.plainChain = None
+		self.transformedChain = None
+		#durations of metric phases, set if distance was computed
+		self.metricTimings = None
+
+def recordResult(resultSinks, result):
+	"""Pass result to all sinks. Failing sink is logged, but does not
+	prevent other sinks from getting the result. Results of superseded
+	tasks are dropped.
+	"""
+	if result.task.superseded:
+		logging.debug("Dropping result of superseded %s -> %s", result.task.plainUrl,
+			result.task.transformedUrl)
+		return
+	for sink in resultSinks:
+		try:
+			sink.record(result)
+		except Exception, e:
+			logging.exception("Failed to record result for %s: %s",
+				result.task.plainUrl, e)
+
+def handleFailure(task, error, retryQueue, resultSinks, excInfo=False):
+	"""Schedule retry of task that failed with retryable error, otherwise
+	log and record the failure.
+	
+	@param task: ComparisonTask that failed
+	@param error: the exception
+	@param retryQueue: retry.RetryQueue or None if retries are disabled
+	@param resultSinks: objects whose record() gets ComparisonResults
+	@param excInfo: log traceback of exception being handled
+	@returns: True if task will be retried, task_done() must not be
+	called for it then
+	"""
+	errorClass = classifyError(error)
+	if retryQueue and not task.superseded and retryQueue.retry(task, errorClass):
+		logging.warn("Failed to process %s: %s (%s), will retry. Rulefile: %s",
+			task.plainUrl, error, errorClass, task.ruleFname)
+		return True
+	
+	logging.error("Failed to process %s: %s. Rulefile: %s", task.plainUrl, error,
+		task.ruleFname, exc_info=excInfo)
+	recordResult(resultSinks, ComparisonResult(task, ComparisonResult.ERROR,
+		errorStr=str(error), errorClass=errorClass))
+	return False
+
+def compareResponses(task, plain, transformed, metric, thresholdDistance):
+	"""Compare fetched plain and rewritten pages of a task and log
+	differences.
+	
+	@param task: ComparisonTask that was fetched
+	@param plain: http_client.FetcherOutArgs of plain page
+	@param transformed: http_client.FetcherOutArgs of rewritten page
+	@param metric: metric.Metric instance
+	@param thresholdDistance: min distance that is reported as "too big"
+	@returns: ComparisonResult
+	"""
+	result = _compareResponses(task, plain, transformed, metric, thresholdDistance)
+	result.plainChain = plain.chain
+	result.transformedChain = transformed.chain
+	return result
+
+def _compareResponses(task, plain, transformed, metric, thresholdDistance):
+	plainUrl = task.plainUrl
+	transformedUrl = task.transformedUrl
+	ruleFname = task.ruleFname
+	plainRcode, plainPage = plain.httpCode, plain.data
+	transformedRcode, transformedPage = transformed.httpCode, transformed.data
+	
+	#Compare HTTP return codes - if original page returned 2xx,
+	#but the transformed didn't, consider it an error in ruleset
+	#(note this is not symmetric, we don't care if orig page is broken).
+	#We don't handle 1xx codes for now.
+	if plainRcode//100 == 2 and transformedRcode//100 != 2:
+		logging.error("Non-2xx HTTP code: %s (%d) => %s (%d). Rulefile: %s",
+			plainUrl, plainRcode, transformedUrl, transformedRcode,
+			ruleFname)
+		return ComparisonResult(task, ComparisonResult.NON_2XX, plainRcode,
+			transformedRcode)
+	
+	#distance of partial bodies would be meaningless
+	if plain.truncated or transformed.truncated:
+		logging.warn("Body over size limit, distance not computed: %s (%d) => %s (%d). Rulefile: %s",
+			plainUrl, plainRcode, transformedUrl, transformedRcode, ruleFname)
+		return ComparisonResult(task, ComparisonResult.TRUNCATED, plainRcode,
+			transformedRcode)
+	
+	metricTimings = {}
+	distance = metric.distanceNormed(plainPage, transformedPage, metricTimings)
 	
+	logging.debug("==== D: %0.4f; %s (%d) -> %s (%d) =====",
+		distance,plainUrl, len(plainPage), transformedUrl, len(transformedPage))
+	
+	status = ComparisonResult.OK
+	if distance >= thresholdDistance:
+		logging.info("Big distance %0.4f: %s (%d) -> %s (%d). Rulefile: %s =====",
+			distance, plainUrl, len(plainPage), transformedUrl, len(transformedPage), ruleFname)
+		status = ComparisonResult.BIG_DISTANCE
+	
+	result = ComparisonResult(task, status, plainRcode, transformedRcode, distance)
+	result.metricTimings = metricTimings
+	return result
+
+class FetchThread(threading.Thread):
+	"""Helper thread running a single fetchPage() call, so that plain and
+	rewritten pages of a task can be fetched concurrently.
+	"""
+	
+	def __init__(self, fetcher, url):
+		"""
+		@param fetcher: http_client.HTTPFetcher instance
+		@param url: URL to fetch
+		"""
+		self.fetcher = fetcher
+		self.url = url
+		self.result = None
+		self.excInfo = None
+		threading.Thread.__init__(self)
+	
+	def run(self):
+		try:
+			self.result = self.fetcher.fetchPage(self.url)
+		except Exception:
+			self.excInfo = sys.exc_info()
+	
+	def getResult(self):
+		"""Wait for the fetch to finish and return fetchPage() result.
+		Exception raised by fetchPage() is re-raised here.
+		"""
+		self.join()
+		if self.excInfo:
+			raise self.excInfo[0], self.excInfo[1], self.excInfo[2]
+		return self.result
+
 class UrlComparisonThread(threading.Thread):
 	"""Thread worker for comparing plain and rewritten URLs.
 	"""
 	
-	def __init__(self, taskQueue, metric, thresholdDistance):
+	def __init__(self, taskQueue, metric, thresholdDistance, resultSinks=(), retryQueue=None):
 		"""
 		Comparison thread running HTTP/HTTPS scans.
 		
-		@param taskQueue: Queue.Queue filled with ComparisonTask objects
+		@param taskQueue: scheduler.HostScheduler filled with ComparisonTask objects
 		@param metric: metric.Metric instance
 		@param threshold: min distance that is reported as "too big"
+		@param resultSinks: objects whose record() gets ComparisonResults
+		@param retryQueue: retry.RetryQueue for tasks that failed with
+		transient errors, None to not retry
 		"""
 		self.taskQueue = taskQueue
 		self.metric = metric
 		self.thresholdDistance = thresholdDistance
+		self.resultSinks = resultSinks
+		self.retryQueue = retryQueue
 		threading.Thread.__init__(self)
 
 	def run(self):
@@ -81,48 +490,183 @@ class UrlComparisonThread(threading.Thread):
 			fetcherPlain = task.fetcherPlain
 			fetcherRewriting = task.fetcherRewriting
 			ruleFname = task.ruleFname
+			retried = False
 			
 			try:
 				logging.debug("=**= Start %s => %s ****", plainUrl, transformedUrl)
 				logging.debug("Fetching plain page %s", plainUrl)
-				plainRcode, plainPage = fetcherPlain.fetchHtml(plainUrl)
-				logging.debug("Fetching transformed page %s", transformedUrl)
-				transformedRcode, transformedPage = fetcherRewriting.fetchHtml(transformedUrl)
-				
-				#Compare HTTP return codes - if original page returned 2xx,
-				#but the transformed didn't, consider it an error in ruleset
-				#(note this is not symmetric, we don't care if orig page is broken).
-				#We don't handle 1xx codes for now.
-				if plainRcode//100 == 2 and transformedRcode//100 != 2:
-					logging.error("Non-2xx HTTP code: %s (%d) => %s (%d). Rulefile: %s",
-						plainUrl, plainRcode, transformedUrl, transformedRcode,
-						ruleFname)
-					continue
+				plainFetch = FetchThread(fetcherPlain, plainUrl)
+				plainFetch.start()
 				
-				distance = self.metric.distanceNormed(plainPage, transformedPage)
-				
-				logging.debug("==== D: %0.4f; %s (%d) -> %s (%d) =====",
-					distance,plainUrl, len(plainPage), transformedUrl, len(transformedPage))
+				logging.debug("Fetching transformed page %s", transformedUrl)
+				try:
+					transformed = fetcherRewriting.fetchPage(transformedUrl)
+				finally:
+					#plain page error takes precedence, as if the
+					#fetches were done sequentially
+					plain = plainFetch.getResult()
 				
-				if distance >= self.thresholdDistance:
-					logging.info("Big distance %0.4f: %s (%d) -> %s (%d). Rulefile: %s =====",
-						distance, plainUrl, len(plainPage), transformedUrl, len(transformedPage), ruleFname)
+				result = compareResponses(task, plain, transformed, self.metric,
+					self.thresholdDistance)
+				recordResult(self.resultSinks, result)
 			except Exception, e:
-				logging.exception("Failed to process %s: %s. Rulefile: %s",
-					plainUrl, e, ruleFname)
+				retried = handleFailure(task, e, self.retryQueue, self.resultSinks, True)
 			finally:
-				self.taskQueue.task_done()
+				if not retried:
+					self.taskQueue.task_done(task)
+					logging.info("Finished comparing %s -> %s. Rulefile: %s.",
+						plainUrl, transformedUrl, ruleFname)
+
+class MultiComparisonThread(threading.Thread):
+	"""Single thread worker that runs fetches of all tasks concurrently
+	via http_client.MultiFetcher (CurlMulti-based event loop). Fetched
+	pages are compared by a few helper threads, so that parsing and
+	distance computation don't stall transfers (and make them time out).
+	"""
+	
+	#max number of fetched tasks waiting for comparison per comparison
+	#thread, no new tasks are started above it
+	pendingPerThread = 4
+	
+	def __init__(self, taskQueue, metric, thresholdDistance, maxTransfers, resultSinks=(),
+			retryQueue=None, comparisonThreads=2):
+		"""
+		@param taskQueue: scheduler.HostScheduler filled with ComparisonTask objects
+		@param metric: metric.Metric instance
+		@param threshold: min distance that is reported as "too big"
+		@param maxTransfers: max number of concurrent transfers
+		@param resultSinks: objects whose record() gets ComparisonResults
+		@param retryQueue: retry.RetryQueue for tasks that failed with
+		transient errors, None to not retry
+		@param comparisonThreads: number of threads comparing fetched pages
+		"""
+		self.taskQueue = taskQueue
+		self.metric = metric
+		self.thresholdDistance = thresholdDistance
+		self.resultSinks = resultSinks
+		self.retryQueue = retryQueue
+		self.multiFetcher = http_client.MultiFetcher(maxTransfers)
+		#(task, plain, transformed) tuples for comparison threads
+		self.fetchedQueue = Queue.Queue()
+		self.pendingCond = threading.Condition()
+		self.pendingCount = 0
+		self.maxPending = self.pendingPerThread * comparisonThreads
+		threading.Thread.__init__(self)
+		
+		for i in range(comparisonThreads):
+			t = threading.Thread(target=self.compareFetched)
+			t.setDaemon(True)
+			t.start()
+	
+	def run(self):
+		multiFetcher = self.multiFetcher
+		
+		while True:
+			#take new tasks while there are free transfer slots, block
+			#only when there is nothing else to do
+			while multiFetcher.activeCount() < multiFetcher.maxTransfers:
+				block = (multiFetcher.activeCount() == 0)
+				if not self.waitForComparisons(block):
+					break
+				try:
+					task = self.taskQueue.get(block)
+				except Queue.Empty:
+					break
+				self.startTask(task)
+			
+			multiFetcher.perform()
+	
+	def waitForComparisons(self, block):
+		"""Check that comparison threads keep up with fetches.
+		
+		@param block: wait until they do
+		@returns: True iff new task may be started
+		"""
+		with self.pendingCond:
+			while self.pendingCount >= self.maxPending:
+				if not block:
+					return False
+				self.pendingCond.wait()
+			return True
+	
+	def startTask(self, task):
+		"""Add both fetches of the task, comparison is run once both
+		finish.
+		"""
+		logging.debug("=**= Start %s => %s ****", task.plainUrl, task.transformedUrl)
+		results = {}
+		
+		def fetched(key, result, error):
+			results[key] = (result, error)
+			if len(results) == 2:
+				with self.pendingCond:
+					self.pendingCount += 1
+				self.fetchedQueue.put((task, results["plain"], results["transformed"]))
+		
+		self.multiFetcher.add(task.fetcherPlain, task.plainUrl,
+			lambda result, error: fetched("plain", result, error))
+		self.multiFetcher.add(task.fetcherRewriting, task.transformedUrl,
+			lambda result, error: fetched("transformed", result, error))
+	
+	def compareFetched(self):
+		"""Run by comparison threads, compares tasks from fetchedQueue."""
+		while True:
+			(task, plain, transformed) = self.fetchedQueue.get()
+			try:
+				self.finishTask(task, plain, transformed)
+			finally:
+				with self.pendingCond:
+					self.pendingCount -= 1
+					self.pendingCond.notify()
+	
+	def finishTask(self, task, plain, transformed):
+		"""Compare results of task's fetches. Each of plain and
+		transformed is a tuple (fetch result, exception).
+		"""
+		retried = False
+		try:
+			for (result, error) in (plain, transformed):
+				if error:
+					retried = handleFailure(task, error, self.retryQueue, self.resultSinks)
+					return
+			
+			result = compareResponses(task, plain[0], transformed[0], self.metric,
+				self.thresholdDistance)
+			recordResult(self.resultSinks, result)
+		except Exception, e:
+			retried = handleFailure(task, e, self.retryQueue, self.resultSinks, True)
+		finally:
+			if not retried:
+				self.taskQueue.task_done(task)
 				logging.info("Finished comparing %s -> %s. Rulefile: %s.",
-					plainUrl, transformedUrl, ruleFname)
+					task.plainUrl, task.transformedUrl, task.ruleFname)
 
 
 if __name__ == "__main__":
-	if len(sys.argv) < 2:
-		print >> sys.stderr, "check_rules.py checker.config"
-		sys.exit(1)
+	parser = argparse.ArgumentParser(description="Check HTTPS Everywhere rulesets "
+		"by comparing plain and rewritten pages of their targets.")
+	parser.add_argument("config", help="checker config file")
+	parser.add_argument("--dns-sweep", action="store_true",
+		help="only resolve targets of rulesets and report non-existent ones, "
+		"nothing is fetched")
+	parser.add_argument("--shard", metavar="i/N", type=parseShard, default=(0, 1),
+		help="check only i-th of N disjoint parts of rulesets (numbered from 0)")
+	parser.add_argument("--resume", action="store_true",
+		help="skip URL pairs completed by interrupted run, as recorded in "
+		"[journal] file")
+	modeGroup = parser.add_mutually_exclusive_group()
+	modeGroup.add_argument("--coordinator", metavar="DB",
+		help="only create tasks and put them into shared SQLite database DB "
+		"for worker processes, collect their results")
+	modeGroup.add_argument("--worker", metavar="DB",
+		help="run tasks from shared SQLite database DB filled by coordinator")
+	args = parser.parse_args()
 	
-	config = SafeConfigParser()
-	config.read(sys.argv[1])
+	#shard can be used in config values, e.g. state-%(shard_index)s.sqlite
+	(shardIndex, shardCount) = args.shard
+	config = SafeConfigParser({"shard_index": str(shardIndex),
+		"shard_count": str(shardCount)})
+	config.read(args.config)
 	
 	logfile = config.get("log", "logfile")
 	loglevel = convertLoglevel(config.get("log", "loglevel"))
@@ -137,6 +681,11 @@ if __name__ == "__main__":
 	certdir = config.get("certificates", "basedir")
 	
 	threadCount = config.getint("http", "threads")
+	fetchEngine = "threads"
+	if config.has_option("http", "fetch_engine"):
+		fetchEngine = config.get("http", "fetch_engine")
+	if fetchEngine not in ("threads", "multi"):
+		raise ValueError("Fetch engine '%s' is not known" % fetchEngine)
 	
 	#get all platform dirs, make sure "default" is among them
 	certdirFiles = glob.glob(os.path.join(certdir, "*"))
@@ -150,74 +699,411 @@ if __name__ == "__main__":
 	metricClass = getMetricClass(metricName)
 	metric = metricClass()
 	
+	fqdnCacheSize = 4096
+	urlCacheSize = 0
+	if config.has_option("rulesets", "fqdn_cache_size"):
+		fqdnCacheSize = config.getint("rulesets", "fqdn_cache_size")
+	if config.has_option("rulesets", "url_cache_size"):
+		urlCacheSize = config.getint("rulesets", "url_cache_size")
+	
 	xmlFnames = glob.glob(os.path.join(ruledir, "*.xml"))
-	trie = RuleTrie()
+	shardFnames = set(xmlFname for xmlFname in xmlFnames
+		if rulesetShard(xmlFname, shardCount) == shardIndex)
+	if shardCount > 1:
+		logging.info("Checking shard %d/%d: %d of %d rulesets.", shardIndex,
+			shardCount, len(shardFnames), len(xmlFnames))
+	#rulesets of other shards are still needed for rewriting redirects
+	if config.has_option("rulesets", "shard_full_trie") and \
+			not config.getboolean("rulesets", "shard_full_trie"):
+		xmlFnames = [xmlFname for xmlFname in xmlFnames if xmlFname in shardFnames]
+	trie = RuleTrie(fqdnCacheSize, urlCacheSize)
 	
-	# set of main pages to test
-	mainPages = set()
+	# rulesets that are not default_off
+	enabledRulesets = []
+	skippedRulesetCount = 0
 	
-	for xmlFname in xmlFnames:
-		ruleset = Ruleset(etree.parse(file(xmlFname)).getroot(), xmlFname)
-		if ruleset.defaultOff:
-			logging.debug("Skipping rule '%s', reason: %s", ruleset.name, ruleset.defaultOff)
-			continue
-		for target in ruleset.uniqueTargetFQDNs():
-			targetHTTPLangingPage = "http://%s/" % target
-			if not ruleset.excludes(targetHTTPLangingPage):
-				mainPages.add(targetHTTPLangingPage)
-			else:
-				logging.debug("Skipping landing page %s", targetHTTPLangingPage)
-		trie.addRuleset(ruleset)
+	rulesetCacheFname = None
+	loadProcesses = None
+	streamTasks = False
+	if config.has_option("rulesets", "cache_file"):
+		rulesetCacheFname = config.get("rulesets", "cache_file")
+	if config.has_option("rulesets", "load_processes"):
+		loadProcesses = config.getint("rulesets", "load_processes")
+	if config.has_option("rulesets", "stream_tasks"):
+		streamTasks = config.getboolean("rulesets", "stream_tasks")
+	if args.dns_sweep or args.worker:
+		streamTasks = False
+	
+	#shared task queue of distributed run
+	leaseTime = 300
+	maxLeases = 3
+	leaseBatchSize = 50
+	pollInterval = 2.0
+	if config.has_option("distributed", "lease_time"):
+		leaseTime = config.getint("distributed", "lease_time")
+	if config.has_option("distributed", "max_leases"):
+		maxLeases = config.getint("distributed", "max_leases")
+	if config.has_option("distributed", "batch_size"):
+		leaseBatchSize = config.getint("distributed", "batch_size")
+	if config.has_option("distributed", "poll_interval"):
+		pollInterval = config.getfloat("distributed", "poll_interval")
+	
+	#addresses of target hosts resolved in bulk, passed to libcurl
+	dnsCache = None
+	deadTargetsReport = None
+	if config.has_section("dns") or args.dns_sweep:
+		dnsTTL = 300
+		dnsThreads = 20
+		dnsTimeout = 5
+		if config.has_option("dns", "ttl"):
+			dnsTTL = config.getint("dns", "ttl")
+		if config.has_option("dns", "threads"):
+			dnsThreads = config.getint("dns", "threads")
+		if config.has_option("dns", "timeout"):
+			dnsTimeout = config.getfloat("dns", "timeout")
+		if config.has_option("dns", "dead_targets_report"):
+			deadTargetsReport = config.get("dns", "dead_targets_report")
+		elif args.dns_sweep:
+			deadTargetsReport = "-"
+		dnsCache = DNSCache(dnsTTL, dnsThreads, dnsTimeout)
 	
 	fetchOptions = http_client.FetchOptions(config)
 	fetcherMap = dict() #maps platform to fetcher
 	
+	#latencies of all fetches for deriving timeouts of next ones
+	latencyTracker = None
+	if fetchOptions.adaptiveTimeouts:
+		latencyTracker = LatencyTracker(fetchOptions.adaptiveTimeoutFloor,
+			fetchOptions.adaptiveTimeoutCeiling)
+	
 	platforms = http_client.CertificatePlatforms(os.path.join(certdir, "default"))
 	for platform in havePlatforms:
 		#adding "default" again won't break things
 		platforms.addPlatform(platform, os.path.join(certdir, platform))
-		fetcher = http_client.HTTPFetcher(platform, platforms, fetchOptions, trie)
+		fetcher = http_client.HTTPFetcher(platform, platforms, fetchOptions, trie, dnsCache,
+			latencyTracker)
 		fetcherMap[platform] = fetcher
 	
 	#fetches pages with unrewritten URLs
-	fetcherPlain = http_client.HTTPFetcher("default", platforms, fetchOptions)
+	fetcherPlain = http_client.HTTPFetcher("default", platforms, fetchOptions,
+		dnsCache=dnsCache, latencyTracker=latencyTracker)
 	
-	taskQueue = Queue.Queue(1000)
-	startTime = time.time()
-	testedUrlPairCount = 0
+	#objects recording results of comparisons
+	timingHistograms = TimingHistograms()
+	resultSinks = [timingHistograms]
+	stateStore = None
+	incremental = False
+	stateTTL = 86400
+	#workers write results to shared queue, coordinator records them
+	if config.has_section("state") and not args.worker:
+		stateStore = StateStore(config.get("state", "dbfile"))
+		resultSinks.append(stateStore)
+		if config.has_option("state", "incremental"):
+			incremental = config.getboolean("state", "incremental")
+		if config.has_option("state", "ttl"):
+			stateTTL = config.getint("state", "ttl")
+	
+	#structured records of all results, DNS sweep keeps records of previous
+	#run intact
+	jsonlSink = None
+	if config.has_option("results", "jsonl_file") and not args.worker and \
+			not args.dns_sweep:
+		jsonlSink = JSONLinesSink(config.get("results", "jsonl_file"), metricName,
+			args.resume)
+		jsonlSink.start()
+		resultSinks.append(jsonlSink)
 	
-	for i in range(threadCount):
-		t = UrlComparisonThread(taskQueue, metric, thresholdDistance)
+	#checkpoints of completed comparisons for resuming interrupted run,
+	#kept intact by DNS sweep
+	journal = None
+	if config.has_section("journal") and not args.worker and not args.dns_sweep:
+		syncRecords = 100
+		syncInterval = 5.0
+		if config.has_option("journal", "sync_records"):
+			syncRecords = config.getint("journal", "sync_records")
+		if config.has_option("journal", "sync_interval"):
+			syncInterval = config.getfloat("journal", "sync_interval")
+		#journal must not get ahead of results it vouches for
+		journal = Journal(config.get("journal", "file"), args.resume, syncRecords,
+			syncInterval, [sink for sink in (stateStore, jsonlSink) if sink])
+		resultSinks.append(journal)
+		if args.resume:
+			logging.info("Resuming run, %d URL pairs were completed before.",
+				journal.resumedCount)
+	elif args.resume and not args.dns_sweep:
+		parser.error("--resume requires [journal] section in config")
+	
+	maxTasksPerHost = 2
+	if config.has_option("http", "max_tasks_per_host"):
+		maxTasksPerHost = config.getint("http", "max_tasks_per_host")
+	if args.coordinator:
+		#tasks go to shared database, comparisons are run by workers
+		taskQueue = SharedTaskQueue(args.coordinator, leaseTime, maxLeases, pollInterval)
+		taskQueue.reset()
+	else:
+		#not bounded, so that tasks of many hosts are available to interleave
+		taskQueue = HostScheduler(maxTasksPerHost, lambda task: taskGroupKey(task, dnsCache))
+	
+	leaser = None
+	if args.worker:
+		def makeTask(plainUrl, transformedUrl, ruleFname, rulesetDigest, platform):
+			fetcher = fetcherMap.get(platform) or fetcherMap["default"]
+			if dnsCache:
+				dnsCache.prefetch([urlparse.urlparse(url).hostname
+					for url in (plainUrl, transformedUrl)])
+			return ComparisonTask(plainUrl, transformedUrl, fetcherPlain, fetcher,
+				ruleFname, rulesetDigest)
+		
+		sharedQueue = SharedTaskQueue(args.worker, leaseTime, maxLeases, pollInterval)
+		leaser = TaskLeaser(sharedQueue, taskQueue, makeTask, leaseBatchSize)
+		resultSinks.append(leaser)
+	
+	#failed tasks are retried with exponential backoff
+	retryAttempts = 3
+	retryDelay = 5.0
+	retryMaxDelay = 300.0
+	if config.has_option("http", "retry_attempts"):
+		retryAttempts = config.getint("http", "retry_attempts")
+	if config.has_option("http", "retry_delay"):
+		retryDelay = config.getfloat("http", "retry_delay")
+	if config.has_option("http", "retry_max_delay"):
+		retryMaxDelay = config.getfloat("http", "retry_max_delay")
+	retryQueue = None
+	if retryAttempts > 1 and not args.coordinator:
+		retryQueue = RetryQueue(taskQueue, retryAttempts, retryDelay, retryMaxDelay,
+			latencyTracker)
+		retryQueue.start()
+	producer = TaskProducer(taskQueue, trie, fetcherMap, fetcherPlain)
+	if incremental:
+		producer.stateStore = stateStore
+		producer.stateTTL = stateTTL
+	producer.dnsCache = dnsCache
+	producer.journal = journal
+	startTime = None
+	
+	#first SIGINT/SIGTERM stops queuing of tasks and lets running ones
+	#finish, second one exits immediately
+	stopping = threading.Event()
+	mainPid = os.getpid()
+	def stopRun(signum, frame):
+		if os.getpid() != mainPid:
+			#forked ruleset loader, terminated by us or ignoring Ctrl-C
+			if signum == signal.SIGTERM:
+				os._exit(1)
+			return
+		if stopping.isSet():
+			logging.warn("Got signal %d again, exiting now.", signum)
+			#journal syncs the other sinks first
+			if journal:
+				journal.close()
+			else:
+				for sink in (stateStore, jsonlSink):
+					if sink:
+						sink.sync()
+			os._exit(1)
+		logging.warn("Got signal %d, finishing running comparisons. Send it again to exit now.",
+			signum)
+		stopping.set()
+	signal.signal(signal.SIGINT, stopRun)
+	signal.signal(signal.SIGTERM, stopRun)
+	
+	def drain():
+		"""Drop waiting tasks, so that only running ones are finished."""
+		dropped = taskQueue.clear()
+		if retryQueue:
+			dropped.extend(retryQueue.clear())
+		if leaser:
+			leaser.stop(dropped)
+		logging.warn("Dropped %d waiting comparisons.", len(dropped))
+	
+	def startWorkers():
+		if args.coordinator:
+			pass
+		elif fetchEngine == "multi":
+			maxTransfers = 500
+			if config.has_option("http", "multi_max_transfers"):
+				maxTransfers = config.getint("http", "multi_max_transfers")
+			comparisonThreads = 2
+			if config.has_option("http", "multi_comparison_threads"):
+				comparisonThreads = config.getint("http", "multi_comparison_threads")
+			t = MultiComparisonThread(taskQueue, metric, thresholdDistance,
+				maxTransfers, resultSinks, retryQueue, comparisonThreads)
+			t.setDaemon(True)
+			t.start()
+		else:
+			for i in range(threadCount):
+				t = UrlComparisonThread(taskQueue, metric, thresholdDistance,
+					resultSinks, retryQueue)
+				t.setDaemon(True)
+				t.start()
+		return time.time()
+	
+	# set of main pages to test
+	mainPages = set()
+	
+	loadStartTime = time.time()
+	for ruleset in loadRulesets(xmlFnames, rulesetCacheFname, loadProcesses):
+		if stopping.isSet():
+			break
+		
+		if ruleset.filename not in shardFnames:
+			if not ruleset.defaultOff:
+				trie.addRuleset(ruleset)
+			continue
+		
+		if ruleset.defaultOff:
+			logging.debug("Skipping rule '%s', reason: %s", ruleset.name, ruleset.defaultOff)
+			skippedRulesetCount += 1
+			continue
+		
+		trie.addRuleset(ruleset)
+		enabledRulesets.append(ruleset)
+		pages = landingPages(ruleset)
+		mainPages.update(pages)
+		
+		if not streamTasks:
+			continue
+		
+		#resolved in background, fetches wait for the names if needed
+		if dnsCache:
+			dnsCache.prefetch(ruleset.uniqueTargetFQDNs())
+		
+		#workers are started only once loader processes are running, so
+		#that they are not forked with our threads
+		if startTime is None:
+			startTime = startWorkers()
+		
+		for plainUrl in pages:
+			if plainUrl not in producer.rewrites:
+				producer.queue(plainUrl)
+	
+	trie.freeze()
+	logging.info("Loaded %d rulesets in %.2f seconds.", len(xmlFnames),
+		time.time() - loadStartTime)
+	
+	#DNS sweep over all targets, pages of non-existent ones are not queued
+	targets = None
+	if dnsCache:
+		targets = targetRulesets(enabledRulesets)
+	if dnsCache and not streamTasks and not args.worker and not stopping.isSet():
+		dnsStartTime = time.time()
+		dnsCache.resolveAll(targets)
+		deadCount = writeDeadTargets(deadTargetsReport, targets, dnsCache)
+		logging.info("Resolved %d targets in %.2f seconds, non-existent: %d. DNS cache: %s",
+			len(targets), time.time() - dnsStartTime, deadCount, dnsCache.stats())
+	
+	if args.dns_sweep:
+		sys.exit(0)
+	
+	if config.has_option("rulesets", "precompile") and \
+			config.getboolean("rulesets", "precompile"):
+		t = threading.Thread(target=precompileRulesets, args=(enabledRulesets,))
 		t.setDaemon(True)
 		t.start()
 	
+	if startTime is None:
+		startTime = startWorkers()
+	
+	if args.worker:
+		#tasks come from coordinator
+		mainPages = ()
+		leaser.start()
+	
 	for plainUrl in mainPages:
-		try:
-			ruleFname = None
-			ruleMatch = trie.transformUrl(plainUrl)
-			transformedUrl = ruleMatch.url
-			
-			if plainUrl == transformedUrl:
-				logging.info("Identical URL: %s", plainUrl)
-				continue
-			
-			#URL was transformed, thus ruleset must exist that did it
-			ruleFname = os.path.basename(ruleMatch.ruleset.filename)
-			fetcher = fetcherMap.get(ruleMatch.ruleset.platform)
-			if not fetcher:
-				logging.warn("Unknown platform '%s', using 'default' instead. Rulefile: %s.",
-					ruleMatch.ruleset.platform, ruleFname)
-				fetcher = fetcherMap["default"]
-				
-		except:
-			logging.exception("Failed to transform plain URL %s. Rulefile: %s.",
-				plainUrl, ruleFname)
-			continue
+		if stopping.isSet():
+			break
 		
-		testedUrlPairCount += 1
-		task = ComparisonTask(plainUrl, transformedUrl, fetcherPlain, fetcher, ruleFname)
-		taskQueue.put(task)
+		if streamTasks:
+			#Reconciliation - page was rewritten using only rulesets loaded
+			#before it. Queue it again if the complete trie rewrites it
+			#differently (rulesets apply in no particular order, so this
+			#is only a rare case of targets claimed by several rulesets).
+			try:
+				expectedUrl = producer.rewrites[plainUrl] or plainUrl
+				if trie.transformUrl(plainUrl).url == expectedUrl:
+					continue
+			except Exception:
+				pass #createTask will log it
+			logging.debug("Rewrite of %s changed after all rulesets were loaded", plainUrl)
 		
-	taskQueue.join()
-	logging.info("Finished in %.2f seconds. Loaded rulesets: %d, URL pairs: %d.",
-		time.time() - startTime, len(xmlFnames), testedUrlPairCount)
\ No newline at end of file
+		producer.queue(plainUrl)
+	
+	if args.coordinator:
+		def recordSharedResult(row):
+			task = ComparisonTask(row["plain_url"], row["transformed_url"], None, None,
+				row["rule_fname"], row["ruleset_digest"])
+			task.attempts = row["attempts"]
+			#task of a stale rewrite, streamed before all rulesets were loaded
+			task.superseded = producer.rewrites.get(row["plain_url"]) != row["transformed_url"]
+			result = ComparisonResult(task, row["status"], row["plain_code"],
+				row["transformed_code"], row["distance"], row["error"], row["error_class"])
+			(result.plainChain, result.transformedChain, result.metricTimings) = row["chains"]
+			recordResult(resultSinks, result)
+		
+		taskQueue.finishProducing()
+	
+	#joins are polled, so that signals are handled meanwhile
+	drained = False
+	while True:
+		if args.coordinator:
+			done = taskQueue.join(1.0, recordSharedResult)
+		elif args.worker:
+			done = leaser.wait(1.0)
+		else:
+			done = taskQueue.join(1.0)
+		if done:
+			break
+		if journal:
+			journal.syncIfDue()
+		if stopping.isSet() and not drained:
+			drain()
+			drained = True
+	
+	if args.coordinator:
+		for (plainUrl, transformedUrl, ruleFname) in taskQueue.failedTasks():
+			logging.error("Workers failed to finish %s -> %s too many times. Rulefile: %s",
+				plainUrl, transformedUrl, ruleFname)
+			task = ComparisonTask(plainUrl, transformedUrl, None, None, ruleFname)
+			task.superseded = producer.rewrites.get(plainUrl) != transformedUrl
+			recordResult(resultSinks, ComparisonResult(task, ComparisonResult.ERROR,
+				errorStr="Lease expired", errorClass="lease_expired"))
+		logging.info("Shared task queue: %s", ", ".join("%s %d" % item
+			for item in sorted(taskQueue.counts().items())))
+		taskQueue.close()
+	elif args.worker:
+		logging.info("Finished %d tasks from shared task queue.", leaser.leasedCount)
+	if dnsCache and streamTasks and not stopping.isSet():
+		#targets were resolved in background, wait for the stragglers
+		dnsCache.resolveAll(targets)
+		writeDeadTargets(deadTargetsReport, targets, dnsCache)
+	http_client.HTTPFetcher.shutdownWorkerPool()
+	#journal syncs the other sinks, so it is closed first
+	if journal:
+		journal.close()
+	if stateStore:
+		stateStore.close()
+	if jsonlSink:
+		jsonlSink.close()
+		logging.info("Wrote %d result records to %s.", jsonlSink.writtenCount,
+			jsonlSink.fname)
+	if args.resume:
+		logging.info("Skipped %d URL pairs completed before resume.", producer.journaledCount)
+	if incremental:
+		logging.info("Skipped %d URL pairs checked recently with same ruleset.",
+			producer.freshCount)
+	if dnsCache:
+		logging.info("Skipped %d URL pairs of non-existent domains. DNS cache: %s",
+			producer.deadCount, dnsCache.stats())
+	if retryQueue:
+		logging.info("Retried %d failed comparisons.", retryQueue.retriedCount)
+	if latencyTracker:
+		logging.info("Fetch latency: %s", latencyTracker.stats())
+	for line in timingHistograms.report():
+		logging.info("Timing of %s", line)
+	logging.info("Rule trie %s", trie.cacheStats())
+	logging.info("Finished in %.2f seconds. Loaded rulesets: %d, skipped default_off: %d, URL pairs: %d.",
+		time.time() - startTime, len(shardFnames), skippedRulesetCount,
+		leaser and leaser.leasedCount or producer.queuedCount)
+	if stopping.isSet():
+		logging.warn("Run was interrupted%s.", journal and ", continue it with --resume" or "")
+		sys.exit(1)
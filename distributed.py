@@ -0,0 +1,394 @@
+import time
+import socket
+import os
+import sqlite3
+import logging
+import threading
+import contextlib
+import json
+
+class SharedTaskQueue(object):
+	"""Queue of comparison tasks in SQLite database shared by coordinator
+	and worker processes. Coordinator puts tasks in and collects results,
+	workers lease batches of tasks and write results back. Lease of a
+	task expires unless the worker renews it, so tasks of workers that
+	died are handed out again.
+
+	Several workers on one machine (or on a filesystem with working
+	POSIX locks) may use the same database.
+	"""
+
+	#tasks inserted by coordinator in one transaction
+	insertBatch = 100
+
+	def __init__(self, dbFname, leaseTime=300, maxLeases=3, pollInterval=2.0):
+		"""Open (and create if needed) the database.
+
+		@param dbFname: path to SQLite database file
+		@param leaseTime: seconds after which task not renewed by its
+		worker may be leased by another worker
+		@param maxLeases: number of expired leases after which task is
+		failed instead of leased again (it probably kills workers)
+		@param pollInterval: seconds between checks of the database
+		"""
+		self.conn = sqlite3.connect(dbFname, timeout=60, isolation_level=None,
+			check_same_thread=False)
+		#URLs are passed to fetchers as str
+		self.conn.text_factory = str
+		self.lock = threading.Lock()
+		self.leaseTime = leaseTime
+		self.maxLeases = maxLeases
+		self.pollInterval = pollInterval
+		self.pending = []
+		self.lastResultId = 0
+		self.lastCounts = None
+
+		self.conn.execute("PRAGMA journal_mode=WAL")
+		self.conn.execute("PRAGMA synchronous=NORMAL")
+		self.conn.execute("""CREATE TABLE IF NOT EXISTS tasks (
+			id INTEGER PRIMARY KEY,
+			plain_url TEXT NOT NULL,
+			transformed_url TEXT NOT NULL,
+			rule_fname TEXT,
+			ruleset_digest TEXT,
+			platform TEXT,
+			state TEXT NOT NULL,
+			worker TEXT,
+			lease_expiry REAL,
+			leases INTEGER NOT NULL DEFAULT 0)""")
+		self.conn.execute("CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, id)")
+		self.conn.execute("""CREATE TABLE IF NOT EXISTS results (
+			id INTEGER PRIMARY KEY,
+			task_id INTEGER NOT NULL,
+			worker TEXT,
+			status TEXT,
+			distance REAL,
+			plain_code INTEGER,
+			transformed_code INTEGER,
+			error TEXT,
+			error_class TEXT,
+			attempts INTEGER,
+			finished REAL,
+			chains TEXT)""")
+		#databases created by older versions lack the later columns
+		columns = set(row[1] for row in self.conn.execute("PRAGMA table_info(results)"))
+		if "chains" not in columns:
+			self.conn.execute("ALTER TABLE results ADD COLUMN chains TEXT")
+		self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+	@contextlib.contextmanager
+	def _transaction(self):
+		"""Run statements of the with block in one write transaction."""
+		with self.lock:
+			self.conn.execute("BEGIN IMMEDIATE")
+			try:
+				yield
+			except:
+				self.conn.execute("ROLLBACK")
+				raise
+			self.conn.execute("COMMIT")
+
+	#coordinator side
+
+	def reset(self):
+		"""Remove tasks and results of previous run and mark that tasks are
+		being produced. Called by coordinator before first put().
+		"""
+		with self._transaction():
+			self.conn.execute("DELETE FROM tasks")
+			self.conn.execute("DELETE FROM results")
+			self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('producing', '1')")
+		self.lastResultId = 0
+
+	def put(self, task):
+		"""Add task for workers, tasks are inserted in batches.
+
+		@param task: check_rules.ComparisonTask
+		"""
+		self.pending.append((task.plainUrl, task.transformedUrl, task.ruleFname,
+			task.rulesetDigest, task.fetcherRewriting.platform))
+		if len(self.pending) >= self.insertBatch:
+			self.flush()
+
+	def flush(self):
+		"""Insert tasks buffered by put()."""
+		if not self.pending:
+			return
+		with self._transaction():
+			self.conn.executemany("INSERT INTO tasks (plain_url, transformed_url, " \
+				"rule_fname, ruleset_digest, platform, state) VALUES (?, ?, ?, ?, ?, 'waiting')",
+				self.pending)
+		self.pending = []
+
+	def finishProducing(self):
+		"""Flush buffered tasks and mark that no more will come, so that
+		workers exit once all tasks are done.
+		"""
+		self.flush()
+		with self.lock:
+			self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('producing', '0')")
+
+	def newResults(self):
+		"""Return results written by workers since last call.
+
+		@returns: list of dicts with keys plain_url, transformed_url,
+		rule_fname, ruleset_digest and columns of results table; chains
+		is tuple of redirect chains of plain and transformed page and
+		metric timings
+		"""
+		with self.lock:
+			cursor = self.conn.execute("SELECT r.id, t.plain_url, t.transformed_url, " \
+				"t.rule_fname, t.ruleset_digest, r.worker, r.status, r.distance, " \
+				"r.plain_code, r.transformed_code, r.error, r.error_class, r.attempts, r.chains " \
+				"FROM results r JOIN tasks t ON r.task_id = t.id WHERE r.id > ? ORDER BY r.id",
+				(self.lastResultId,))
+			names = [d[0] for d in cursor.description]
+			rows = [dict(zip(names, row)) for row in cursor.fetchall()]
+		for row in rows:
+			row["chains"] = tuple(json.loads(row["chains"] or "[null, null, null]"))
+		if rows:
+			self.lastResultId = rows[-1]["id"]
+		return rows
+
+	def counts(self):
+		"""Return dict mapping task state ("waiting", "leased", "done",
+		"failed") to number of tasks.
+		"""
+		with self.lock:
+			return dict(self.conn.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state"))
+
+	def join(self, timeout=None, onResult=None):
+		"""Wait until all tasks are done or failed. Tasks whose leases
+		expired too many times are failed meanwhile.
+
+		@param timeout: max seconds to wait, None for no limit
+		@param onResult: function called with each new result from
+		newResults()
+		@returns: True if all tasks are done, False on timeout
+		"""
+		if timeout is not None:
+			deadline = time.time() + timeout
+		while True:
+			self._failExpired()
+			for row in self.newResults():
+				if onResult:
+					onResult(row)
+			counts = self.counts()
+			if counts != self.lastCounts:
+				logging.info("Shared task queue: %s", ", ".join("%s %d" % item
+					for item in sorted(counts.items())))
+				self.lastCounts = counts
+			if not counts.get("waiting") and not counts.get("leased"):
+				break
+			if timeout is not None and time.time() >= deadline:
+				return False
+			time.sleep(self.pollInterval)
+
+		for row in self.newResults():
+			if onResult:
+				onResult(row)
+		return True
+
+	def clear(self):
+		"""Remove tasks not leased by any worker yet, e.g. when the run is
+		interrupted.
+
+		@returns: list of IDs of removed tasks
+		"""
+		self.pending = []
+		with self._transaction():
+			taskIds = [row[0] for row in
+				self.conn.execute("SELECT id FROM tasks WHERE state = 'waiting'")]
+			self.conn.execute("DELETE FROM tasks WHERE state = 'waiting'")
+		return taskIds
+
+	def failedTasks(self):
+		"""Return list of (plain URL, transformed URL, rule file name)
+		tuples of tasks failed because of expired leases.
+		"""
+		with self.lock:
+			return self.conn.execute("SELECT plain_url, transformed_url, rule_fname " \
+				"FROM tasks WHERE state = 'failed'").fetchall()
+
+	def _failExpired(self):
+		with self.lock:
+			self.conn.execute("UPDATE tasks SET state = 'failed' WHERE state = 'leased' " \
+				"AND lease_expiry < ? AND leases >= ?", (time.time(), self.maxLeases))
+
+	#worker side
+
+	def lease(self, worker, count):
+		"""Lease up to count tasks that are waiting or whose lease expired.
+
+		@param worker: ID of the worker
+		@returns: list of tuples (task ID, plain URL, transformed URL, rule
+		file name, ruleset digest, platform, number of leases)
+		"""
+		now = time.time()
+		with self._transaction():
+			rows = self.conn.execute("SELECT id, plain_url, transformed_url, rule_fname, " \
+				"ruleset_digest, platform, leases FROM tasks WHERE state = 'waiting' " \
+				"OR (state = 'leased' AND lease_expiry < ? AND leases < ?) " \
+				"ORDER BY id LIMIT ?", (now, self.maxLeases, count)).fetchall()
+			self.conn.executemany("UPDATE tasks SET state = 'leased', worker = ?, " \
+				"lease_expiry = ?, leases = leases + 1 WHERE id = ?",
+				[(worker, now + self.leaseTime, row[0]) for row in rows])
+		return [row[:6] + (row[6] + 1,) for row in rows]
+
+	def renew(self, worker, taskIds):
+		"""Extend leases of tasks the worker is still working on."""
+		if not taskIds:
+			return
+		expiry = time.time() + self.leaseTime
+		with self._transaction():
+			self.conn.executemany("UPDATE tasks SET lease_expiry = ? " \
+				"WHERE id = ? AND worker = ? AND state = 'leased'",
+				[(expiry, taskId, worker) for taskId in taskIds])
+
+	def complete(self, worker, taskId, result):
+		"""Write result of task and mark it done, unless the worker lost its
+		lease meanwhile (the task was leased by another worker or failed).
+
+		@param result: check_rules.ComparisonResult
+		@returns: True iff the result was written
+		"""
+		with self._transaction():
+			cursor = self.conn.execute("UPDATE tasks SET state = 'done' " \
+				"WHERE id = ? AND worker = ? AND state = 'leased'", (taskId, worker))
+			if cursor.rowcount != 1:
+				return False
+			self.conn.execute("INSERT INTO results (task_id, worker, status, distance, " \
+				"plain_code, transformed_code, error, error_class, attempts, finished, chains) " \
+				"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+				(taskId, worker, result.status, result.distance, result.plainRcode,
+				result.transformedRcode, result.errorStr, result.errorClass,
+				result.attempts, time.time(),
+				json.dumps([result.plainChain, result.transformedChain, result.metricTimings])))
+		return True
+
+	def release(self, worker, taskIds):
+		"""Return leased tasks the worker won't run to the queue."""
+		with self._transaction():
+			self.conn.executemany("UPDATE tasks SET state = 'waiting', worker = NULL, " \
+				"leases = leases - 1 WHERE id = ? AND worker = ? AND state = 'leased'",
+				[(taskId, worker) for taskId in taskIds])
+
+	def finished(self):
+		"""Returns True iff coordinator produced all tasks and none is
+		waiting or leased.
+		"""
+		with self.lock:
+			row = self.conn.execute("SELECT value FROM meta WHERE key = 'producing'").fetchone()
+			if row is None or row[0] != "0":
+				return False
+			row = self.conn.execute("SELECT COUNT(*) FROM tasks " \
+				"WHERE state IN ('waiting', 'leased')").fetchone()
+			return row[0] == 0
+
+	def close(self):
+		self.flush()
+		with self.lock:
+			self.conn.close()
+
+class TaskLeaser(threading.Thread):
+	"""Worker side of distributed run - keeps local task queue filled with
+	tasks leased from SharedTaskQueue, renews leases of tasks in progress
+	and writes their results back (it is a result sink).
+	"""
+
+	def __init__(self, sharedQueue, taskQueue, makeTask, batchSize):
+		"""
+		@param sharedQueue: SharedTaskQueue
+		@param taskQueue: local scheduler.HostScheduler of comparison threads
+		@param makeTask: function creating ComparisonTask from plain URL,
+		transformed URL, rule file name, ruleset digest and platform
+		@param batchSize: number of tasks leased at once; new batch is
+		leased when fewer tasks are waiting locally
+		"""
+		self.sharedQueue = sharedQueue
+		self.taskQueue = taskQueue
+		self.makeTask = makeTask
+		self.batchSize = batchSize
+		self.pollInterval = sharedQueue.pollInterval
+		self.workerId = "%s:%d" % (socket.gethostname(), os.getpid())
+		self.lock = threading.Lock()
+		#maps tasks in progress to their IDs in shared queue
+		self.taskIds = {}
+		self.leasedCount = 0
+		self.done = threading.Event()
+		self.stopping = threading.Event()
+		threading.Thread.__init__(self)
+		self.setDaemon(True)
+
+	def record(self, result):
+		"""Write result of comparison to shared queue.
+
+		@param result: check_rules.ComparisonResult
+		"""
+		with self.lock:
+			taskId = self.taskIds.pop(result.task)
+		if not self.sharedQueue.complete(self.workerId, taskId, result):
+			logging.warn("Lease of %s -> %s was lost before it was finished, result dropped",
+				result.task.plainUrl, result.task.transformedUrl)
+
+	def run(self):
+		lastRenewal = time.time()
+		while True:
+			try:
+				if time.time() - lastRenewal > self.sharedQueue.leaseTime / 3.0:
+					with self.lock:
+						taskIds = self.taskIds.values()
+					self.sharedQueue.renew(self.workerId, taskIds)
+					lastRenewal = time.time()
+
+				leased = []
+				if self.taskQueue.qsize() < self.batchSize and not self.stopping.isSet():
+					leased = self.sharedQueue.lease(self.workerId, self.batchSize)
+				for (taskId, plainUrl, transformedUrl, ruleFname, digest, platform, leases) in leased:
+					task = self.makeTask(plainUrl, transformedUrl, ruleFname, digest, platform)
+					if leases > 1:
+						logging.warn("Lease of %s -> %s expired before, leasing it again. Rulefile: %s",
+							plainUrl, transformedUrl, ruleFname)
+					with self.lock:
+						self.taskIds[task] = taskId
+					self.leasedCount += 1
+					self.taskQueue.put(task)
+
+				if not leased:
+					with self.lock:
+						idle = not self.taskIds
+					if idle and (self.stopping.isSet() or self.sharedQueue.finished()):
+						break
+					time.sleep(self.pollInterval)
+			except sqlite3.Error, e:
+				logging.error("Shared task queue failed: %s, trying again", e)
+				time.sleep(self.pollInterval)
+			except Exception, e:
+				#the thread must keep going, otherwise wait() never returns
+				logging.exception("Leasing tasks failed: %s, trying again", e)
+				time.sleep(self.pollInterval)
+
+		self.done.set()
+
+	def stop(self, tasks):
+		"""Stop leasing new tasks, e.g. when the run is interrupted.
+
+		@param tasks: tasks removed from local task queue, they are
+		returned to the shared queue for other workers
+		"""
+		self.stopping.set()
+		with self.lock:
+			taskIds = [self.taskIds.pop(task) for task in tasks if task in self.taskIds]
+		self.sharedQueue.release(self.workerId, taskIds)
+		self.leasedCount -= len(taskIds)
+
+	def wait(self, timeout=None):
+		"""Wait until there are no more tasks to lease and all leased
+		tasks are done.
+
+		@param timeout: max seconds to wait, None for no limit
+		@returns: True if all tasks are done, False on timeout
+		"""
+		if not self.done.wait(timeout):
+			return False
+		return self.taskQueue.join(timeout)
@@ -0,0 +1,207 @@
+import time
+import socket
+import logging
+import threading
+import Queue
+
+class DNSCache(object):
+	"""Cache of addresses of FQDNs shared by all fetchers. Names are
+	resolved in bulk by a pool of resolver threads and the addresses are
+	passed to libcurl via CURLOPT_RESOLVE, so that neither fetcher
+	subprocesses nor plain/rewritten fetches of the same host resolve
+	it again. Non-existent domains are cached too, so that they can be
+	skipped without a fetch. Expired entries are resolved again in the
+	background when looked up, their addresses are used meanwhile.
+	"""
+
+	#getaddrinfo errors meaning that the name has no address
+	_nxErrors = set([getattr(socket, name) for name in ("EAI_NONAME", "EAI_NODATA")
+		if hasattr(socket, name)])
+
+	#max number of getaddrinfo helper threads (including those of lookups
+	#that timed out and still run) per resolver thread
+	lookupThreadsPerResolver = 2
+
+	def __init__(self, ttl, threads, timeout=5):
+		"""
+		@param ttl: seconds after which cached addresses are refreshed
+		@param threads: number of resolver threads
+		@param timeout: seconds after which resolution of a name is given
+		up (and left to libcurl)
+		"""
+		self.ttl = ttl
+		self.threads = threads
+		self.timeout = timeout
+		#maps FQDN to tuple (expiry time, list of addresses), the list is
+		#empty for non-existent domain
+		self.entries = {}
+		#maps FQDNs being resolved to threading.Event set when done
+		self.pending = {}
+		#maps FQDNs that could not be resolved (timeout, temporary
+		#failure) to description of the failure
+		self.failures = {}
+		self.lock = threading.Lock()
+		self.resolveQueue = Queue.Queue()
+		self.resolverThreads = []
+		self.resolvedCount = 0
+		self.nxCount = 0
+		#released by helper thread when its getaddrinfo returns
+		self.lookupSlots = threading.Semaphore(self.lookupThreadsPerResolver * threads)
+
+	def prefetch(self, fqdns):
+		"""Schedule resolution of FQDNs by resolver threads, names that are
+		cached or already being resolved are skipped. Doesn't block.
+
+		@param fqdns: iterable of IDNA-encoded FQDNs
+		"""
+		if not self.resolverThreads:
+			for i in range(self.threads):
+				t = threading.Thread(target=self._resolverLoop)
+				t.setDaemon(True)
+				t.start()
+				self.resolverThreads.append(t)
+
+		now = time.time()
+		with self.lock:
+			for fqdn in fqdns:
+				entry = self.entries.get(fqdn)
+				if fqdn in self.pending or (entry and entry[0] > now):
+					continue
+				self.pending[fqdn] = threading.Event()
+				self.resolveQueue.put(fqdn)
+
+	def resolveAll(self, fqdns):
+		"""Resolve FQDNs in parallel and wait until all are done.
+
+		@param fqdns: iterable of IDNA-encoded FQDNs
+		"""
+		self.prefetch(fqdns)
+		self.resolveQueue.join()
+
+	def lookup(self, fqdn, wait=False):
+		"""Return cached addresses of FQDN.
+
+		@param fqdn: IDNA-encoded FQDN
+		@param wait: if FQDN is being resolved (or refreshed), wait for
+		the result
+		@returns: list of address strings, empty list for non-existent
+		domain, None if FQDN is not cached
+		"""
+		with self.lock:
+			entry = self.entries.get(fqdn)
+		if entry is not None and entry[0] <= time.time():
+			self.prefetch([fqdn])
+
+		with self.lock:
+			event = self.pending.get(fqdn)
+		if event and wait:
+			event.wait()
+
+		with self.lock:
+			entry = self.entries.get(fqdn)
+		if entry is None:
+			return None
+		return entry[1]
+
+	def isDead(self, fqdn, wait=False):
+		"""Returns True iff FQDN is cached as non-existent domain."""
+		return self.lookup(fqdn, wait) == []
+	
+	def failure(self, fqdn):
+		"""Return description why FQDN could not be resolved, None if it
+		was resolved (or is non-existent) or wasn't tried yet.
+		"""
+		with self.lock:
+			return self.failures.get(fqdn)
+
+	def curlResolve(self, fqdn, port, wait=False):
+		"""Return entries for CURLOPT_RESOLVE pinning FQDN to its cached
+		addresses.
+
+		@param fqdn: IDNA-encoded FQDN
+		@param port: port the entries are for
+		@param wait: if FQDN is being resolved, wait for the result
+		@returns: list with single "host:port:addr,addr" entry or None if
+		there are no cached addresses
+		"""
+		addresses = self.lookup(fqdn, wait)
+		if not addresses:
+			return None
+		addresses = [":" in address and "[%s]" % address or address for address in addresses]
+		return ["%s:%d:%s" % (fqdn, port, ",".join(addresses))]
+
+	def stats(self):
+		"""Return string with resolution counters for logging."""
+		return "resolved %d names, non-existent %d, unresolved %d" % \
+			(self.resolvedCount, self.nxCount, len(self.failures))
+
+	def _resolverLoop(self):
+		while True:
+			fqdn = self.resolveQueue.get()
+			try:
+				self._resolve(fqdn)
+			except Exception:
+				logging.exception("Resolving %s failed", fqdn)
+			finally:
+				with self.lock:
+					event = self.pending.pop(fqdn, None)
+				if event:
+					event.set()
+				self.resolveQueue.task_done()
+
+	def _getaddrinfo(self, fqdn):
+		"""Run getaddrinfo in a helper thread, since it has no timeout of
+		its own. Thread of lookup that timed out is abandoned. If too many
+		abandoned threads still run (resolver is slow or unreachable), the
+		lookup fails without starting another one.
+		
+		@returns: getaddrinfo result
+		@throws: socket.gaierror from getaddrinfo, socket.timeout
+		"""
+		if not self.lookupSlots.acquire(False):
+			raise socket.timeout("too many lookups timed out and still running")
+		
+		result = {}
+		def resolve():
+			try:
+				result["infos"] = socket.getaddrinfo(fqdn, None, 0, socket.SOCK_STREAM)
+			except socket.gaierror, e:
+				result["error"] = e
+			finally:
+				self.lookupSlots.release()
+		
+		t = threading.Thread(target=resolve)
+		t.setDaemon(True)
+		t.start()
+		t.join(self.timeout)
+		if "error" in result:
+			raise result["error"]
+		if "infos" not in result:
+			raise socket.timeout("timed out after %s seconds" % self.timeout)
+		return result["infos"]
+
+	def _resolve(self, fqdn):
+		try:
+			infos = self._getaddrinfo(fqdn)
+		except (socket.gaierror, socket.timeout), e:
+			if getattr(e, "errno", None) not in self._nxErrors:
+				#temporary failure, leave it to libcurl
+				logging.debug("Failed to resolve %s: %s", fqdn, e)
+				with self.lock:
+					self.failures[fqdn] = str(e)
+				return
+			logging.debug("Non-existent domain %s", fqdn)
+			addresses = []
+		else:
+			addresses = []
+			for info in infos:
+				address = info[4][0]
+				if address not in addresses:
+					addresses.append(address)
+
+		with self.lock:
+			self.entries[fqdn] = (time.time() + self.ttl, addresses)
+			self.failures.pop(fqdn, None)
+			self.resolvedCount += 1
+			if not addresses:
+				self.nxCount += 1
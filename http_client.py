@@ -8,6 +8,17 @@ import regex
 import cPickle
 import traceback
 import subprocess
+import struct
+import resource
+import threading
+import collections
+import time
+import tempfile
+import copy
+import signal
+
+from response_cache import ResponseCache
+from latency import endpoint
 
 class CertificatePlatforms(object):
 	"""Maps platform names from rulesets to CA certificate sets"""
@@ -51,7 +62,18 @@ class FetchOptions(object):
 		self.curlVerbose = False
 		self.sslVersion = pycurl.SSLVERSION_DEFAULT
 		self.useSubprocess = True
+		#NSS would resume TLS session of one host for another host on the
+		#same IP in a reused subprocess
+		self.subprocessMaxFetches = curlUsesNSS() and 1 or 100
+		self.subprocessMaxRSS = 256
+		self.maxBodyBytes = 10*1024*1024
+		self.reuseConnections = True
+		self.adaptiveTimeouts = False
+		self.adaptiveTimeoutFloor = 2.0
+		self.adaptiveTimeoutCeiling = 60.0
 		self.staticCAPath = None
+		self.responseCacheDir = None
+		self.responseCacheMaxSize = 512
 
 		if config.has_option("http", "user_agent"):
 			self.userAgent = config.get("http", "user_agent")
@@ -59,6 +81,23 @@ class FetchOptions(object):
 			self.curlVerbose = config.getboolean("http", "curl_verbose")
 		if config.has_option("http", "fetch_in_subprocess"):
 			self.useSubprocess = config.getboolean("http", "fetch_in_subprocess")
+		if config.has_option("http", "subprocess_max_fetches"):
+			self.subprocessMaxFetches = config.getint("http", "subprocess_max_fetches")
+			if self.subprocessMaxFetches != 1 and curlUsesNSS():
+				logging.warn("libcurl uses NSS, subprocess_max_fetches other than 1 "
+					"brings back the CURL+NSS SNI bug (see README)")
+		if config.has_option("http", "subprocess_max_rss"):
+			self.subprocessMaxRSS = config.getint("http", "subprocess_max_rss")
+		if config.has_option("http", "max_body_bytes"):
+			self.maxBodyBytes = config.getint("http", "max_body_bytes")
+		if config.has_option("http", "reuse_connections"):
+			self.reuseConnections = config.getboolean("http", "reuse_connections")
+		if config.has_option("http", "adaptive_timeouts"):
+			self.adaptiveTimeouts = config.getboolean("http", "adaptive_timeouts")
+		if config.has_option("http", "adaptive_timeout_floor"):
+			self.adaptiveTimeoutFloor = config.getfloat("http", "adaptive_timeout_floor")
+		if config.has_option("http", "adaptive_timeout_ceiling"):
+			self.adaptiveTimeoutCeiling = config.getfloat("http", "adaptive_timeout_ceiling")
 		if config.has_option("http", "ssl_version"):
 			versionStr = config.get("http", "ssl_version")
 			try:
@@ -67,21 +106,30 @@ class FetchOptions(object):
 				raise ValueError("SSL version '%s' specified in config is unsupported." % versionStr)
 		if config.has_option("http", "static_ca_path"):
 			self.staticCAPath = config.get("http", "static_ca_path")
+		if config.has_option("http", "response_cache_dir"):
+			self.responseCacheDir = config.get("http", "response_cache_dir")
+		if config.has_option("http", "response_cache_max_size"):
+			self.responseCacheMaxSize = config.getint("http", "response_cache_max_size")
 	
 class FetcherInArgs(object):
 	"""Container for parameters necessary to be passed to CURL fetcher when
 	invoked in subprocess to workaround openssl/gnutls+curl threading bugs.
 	"""
 	
-	def __init__(self, url, options, platformPath):
+	def __init__(self, url, options, platformPath, bodyPath=None, resolve=None):
 		"""
 		@param url: IDNA-encoded URL
 		@param options: FetchOptions instance
 		@param platformPath: directory with platform certificates
+		@param bodyPath: file the response body is written into instead
+		of being sent back in FetcherOutArgs
+		@param resolve: list of CURLOPT_RESOLVE entries or None
 		"""
 		self.url = url
 		self.options = options
 		self.platformPath = platformPath
+		self.bodyPath = bodyPath
+		self.resolve = resolve
 	
 	def check(self):
 		"""Throw HTTPFetcherError unless attributes are set and sane."""
@@ -91,34 +139,392 @@ class FetcherInArgs(object):
 			raise HTTPFetcherError("Options have bad type")
 		if not isinstance(self.platformPath, str) or not self.platformPath:
 			raise HTTPFetcherError("Platform path missing or bad type")
+		if self.bodyPath is not None and not isinstance(self.bodyPath, str):
+			raise HTTPFetcherError("Body path has bad type")
+		if self.resolve is not None and not isinstance(self.resolve, list):
+			raise HTTPFetcherError("Resolve entries have bad type")
 	
 class FetcherOutArgs(object):
 	"""Container for data returned from fetcher. Picklable object to use
 	with subprocess PyCURL invocation.
 	"""
 	
-	def __init__(self, httpCode=None, data=None, headerStr=None, errorStr=None):
+	def __init__(self, httpCode=None, data=None, headerStr=None, errorStr=None,
+			truncated=False, curlErrno=None, timings=None):
 		"""
 		@param httpCode: return HTTP code as int
-		@param data: data fetched from URL as str
+		@param data: data fetched from URL as str, None if it was written
+		into FetcherInArgs.bodyPath
 		@param headerStr: HTTP headers as str
 		@param errorStr: formatted backtrace from exception as str
+		@param truncated: True if body was longer than max_body_bytes and
+		data contain only its beginning
+		@param curlErrno: PyCURL error number if fetch failed with
+		pycurl.error (errorStr then contains its message)
+		@param timings: dict of fetch phase times in seconds from
+		HTTPFetcher.curlTimings(), for subprocess fetches with overhead of
+		the subprocess added by HTTPFetcher._doFetch()
+		
+		Last fetch of redirect chain also gets attribute chain from
+		RedirectFollower - list of (URL, HTTP code, timings) tuples of all
+		fetches in the chain.
 		"""
 		self.httpCode = httpCode
 		self.data = data
 		self.headerStr = headerStr
 		self.errorStr = errorStr
+		self.truncated = truncated
+		self.curlErrno = curlErrno
+		self.timings = timings
+		self.chain = None
+	
+class CappedBuffer(object):
+	"""Buffer for response body used as PyCURL write callback. Once the
+	body exceeds the size limit, the rest is not stored and the write
+	callback makes libcurl abort the transfer with CURLE_WRITE_ERROR.
+	"""
+	
+	def __init__(self, maxBytes, outFile=None):
+		"""
+		@param maxBytes: max number of stored bytes, 0 means no limit
+		@param outFile: file to write the body into instead of memory
+		"""
+		self.outFile = outFile
+		self.buf = outFile or cStringIO.StringIO()
+		self.maxBytes = maxBytes
+		self.size = 0
+		self.truncated = False
+	
+	def write(self, data):
+		if self.maxBytes > 0 and self.size + len(data) > self.maxBytes:
+			self.buf.write(data[:self.maxBytes - self.size])
+			self.size = self.maxBytes
+			self.truncated = True
+			return 0 #short write aborts the transfer
+		self.buf.write(data)
+		self.size += len(data)
+	
+	def getvalue(self):
+		"""Return body as str or None if it was written into file."""
+		if self.outFile:
+			return None
+		return self.buf.getvalue()
+	
+	def close(self):
+		if not self.outFile:
+			self.buf.close()
 	
 class HTTPFetcherError(RuntimeError):
 	pass
 
+class FetcherWorkerGone(HTTPFetcherError):
+	"""Fetcher subprocess was dead before it got the request, so the
+	request can be sent to another one.
+	"""
+	pass
+
+def curlUsesNSS():
+	"""Returns True iff libcurl uses NSS, whose TLS session ID cache is
+	process-wide (see the CURL+NSS SNI bug in README).
+	"""
+	return "NSS/" in pycurl.version
+
+def writeFrame(outFile, data):
+	"""Write one length-prefixed frame of data to file and flush it.
+	
+	@param outFile: file object opened for writing (e.g. pipe)
+	@param data: str to be sent
+	"""
+	outFile.write(struct.pack("!I", len(data)))
+	outFile.write(data)
+	outFile.flush()
+
+def readFrame(inFile):
+	"""Read one length-prefixed frame written by writeFrame.
+	
+	@param inFile: file object opened for reading (e.g. pipe)
+	@returns: str with frame data or None if the other side closed the
+	pipe before whole frame was read
+	"""
+	header = inFile.read(4)
+	if len(header) != 4:
+		return None
+	(length,) = struct.unpack("!I", header)
+	data = inFile.read(length)
+	if len(data) != length:
+		return None
+	return data
+
+#directory for files passing response bodies from fetcher subprocesses,
+#tmpfs-backed /dev/shm if available so that the bodies stay in memory
+_bodyFileDir = os.access("/dev/shm", os.W_OK) and "/dev/shm" or None
+
+def readBodyFile(path):
+	"""Read response body written by fetcher subprocess. This is one copy
+	of the body into the str that metrics need, instead of the copies of
+	sending it through pipe and unpickling it.
+	
+	@param path: path of the body file
+	@returns: body as str
+	"""
+	with open(path, "rb") as f:
+		return f.read()
+
+def connectionKey(url, platformPath):
+	"""Return key under which a PyCURL handle that fetched the URL may be
+	reused. Handles (with their connection and TLS session caches) are
+	reused only for the same host, port and CA path, so that TLS session
+	of one host is never resumed for another host (see the CURL+NSS SNI
+	bug in README).
+	
+	@param url: IDNA-encoded URL
+	@param platformPath: directory with platform certificates
+	"""
+	p = urlparse.urlparse(url)
+	port = p.port or {"http": 80, "https": 443}.get(p.scheme)
+	return (p.scheme, p.hostname, port, platformPath)
+
+class CurlHandleCache(threading.local):
+	"""Per-thread cache of the last used PyCURL handle, so that
+	consecutive fetches from the same host (e.g. hops of a redirect
+	chain) reuse its open connection and TLS session.
+	"""
+	
+	def __init__(self):
+		self.key = None
+		self.handle = None
+	
+	def acquire(self, key):
+		"""Return the cached handle reset to default options if it was
+		used for the same connection key, otherwise a new handle.
+		
+		@param key: connection key from connectionKey()
+		"""
+		handle = self.handle
+		self.handle = None
+		if handle is not None:
+			if self.key == key:
+				handle.reset()
+				return handle
+			handle.close()
+		return pycurl.Curl()
+	
+	def release(self, key, handle):
+		"""Keep handle for reuse by next fetch in this thread.
+		
+		@param key: connection key the handle was used for
+		@param handle: PyCURL handle
+		"""
+		if self.handle is not None:
+			self.handle.close()
+		self.key = key
+		self.handle = handle
+
+#idle PyCURL handles of threads (or fetcher subprocesses)
+_curlHandles = CurlHandleCache()
+
+def currentRSS():
+	"""Return resident set size of this process in MB. Uses /proc if
+	available, otherwise falls back to peak RSS from getrusage.
+	"""
+	try:
+		with open("/proc/self/statm") as statm:
+			pages = int(statm.read().split()[1])
+		return pages * resource.getpagesize() / (1024*1024)
+	except (IOError, IndexError, ValueError):
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class FetcherWorker(object):
+	"""Long-lived fetcher subprocess. Requests (pickled FetcherInArgs)
+	and responses (pickled tuple of FetcherOutArgs and worker's RSS)
+	are exchanged as frames over the subprocess's stdin/stdout.
+	"""
+	
+	def __init__(self):
+		# Workaround for cPickle seeing module name as __main__ if we
+		# just directly executed this script.
+		# TODO: check PYTHONPATH etc if not in the same dir as script
+		# TODO: we should set the main process to be session leader
+		trampoline = 'import http_client; http_client.subprocessFetchLoop()'
+		
+		# Spawn subprocess, call this module as "main" program. I tried
+		# also using python's multiprocessing module, but for some
+		# reason it was a hog on CPU and RAM (maybe due to the queues?)
+		# Also, logging module didn't play along nicely.
+		args = [sys.executable, '-c', trampoline]
+		self.devnull = open(os.devnull, "w")
+		startTime = time.time()
+		self.process = subprocess.Popen(args, stdin=subprocess.PIPE,
+			stdout=subprocess.PIPE, stderr=self.devnull, close_fds=True)
+		#reported with the first fetch, interpreter startup is part of its IPC time
+		self.spawnTime = time.time() - startTime
+		self.fetchCount = 0
+		self.rss = 0
+		#connection key of the last fetch, its handle is cached in the subprocess
+		self.lastKey = None
+	
+	def fetch(self, inArgs):
+		"""Send fetch request to the subprocess and wait for the result.
+		
+		@param inArgs: FetcherInArgs instance
+		@returns: FetcherOutArgs instance, its timings (if any) get
+		durations of spawn (first fetch only), pickle and ipc (round trip
+		minus the fetch itself) phases
+		@throws: HTTPFetcherError if the subprocess died (e.g. SIGSEGV,
+		SIGPIPE), FetcherWorkerGone if it was dead already before getting
+		the request; the subprocess is reaped in such case
+		"""
+		startTime = time.time()
+		request = cPickle.dumps(inArgs, cPickle.HIGHEST_PROTOCOL)
+		sentTime = time.time()
+		try:
+			writeFrame(self.process.stdin, request)
+		except (IOError, OSError):
+			self.kill()
+			raise FetcherWorkerGone("Subprocess failed with exit code %s before fetch" % \
+				self.process.returncode)
+		
+		try:
+			frame = readFrame(self.process.stdout)
+			receivedTime = time.time()
+		except (IOError, OSError):
+			frame = None
+		
+		if frame is None:
+			self.kill()
+			raise HTTPFetcherError("Subprocess failed with exit code %s" % \
+				self.process.returncode)
+		
+		self.fetchCount += 1
+		(outArgs, self.rss) = cPickle.loads(frame)
+		timings = getattr(outArgs, "timings", None)
+		if timings is not None:
+			timings["pickle"] = (sentTime - startTime) + (time.time() - receivedTime)
+			timings["ipc"] = max(0.0, receivedTime - sentTime - timings.get("total", 0.0))
+			if self.fetchCount == 1:
+				timings["spawn"] = self.spawnTime
+		return outArgs
+	
+	def close(self):
+		"""Ask subprocess to exit by closing its stdin and reap it."""
+		try:
+			self.process.stdin.close()
+			self.process.wait()
+		except (IOError, OSError):
+			self.kill()
+		finally:
+			self.devnull.close()
+	
+	def isAlive(self):
+		"""Returns True iff the subprocess is still running."""
+		return self.process.poll() is None
+	
+	def kill(self):
+		"""Kill the subprocess (if still running) and reap it."""
+		try:
+			if self.process.poll() is None:
+				self.process.kill()
+			self.process.wait()
+		except OSError:
+			pass
+		finally:
+			self.devnull.close()
+
+class FetcherWorkerPool(object):
+	"""Pool of FetcherWorker subprocesses. Workers are spawned on demand,
+	so there are at most as many as concurrent fetches. Worker is
+	recycled after given number of fetches or when its RSS grows over
+	limit. Workers that died while idle are replaced by fresh ones
+	transparently, one that died during a fetch fails the fetch.
+	"""
+	
+	def __init__(self, maxFetches, maxRSS):
+		"""
+		@param maxFetches: number of fetches after which a worker is
+		replaced; 1 means new subprocess for every fetch
+		@param maxRSS: RSS in MB above which a worker is replaced,
+		0 means no limit
+		"""
+		self.maxFetches = maxFetches
+		self.maxRSS = maxRSS
+		self.idleWorkers = []
+		self.lock = threading.Lock()
+	
+	def fetch(self, inArgs):
+		"""Run fetch in an idle worker or a newly spawned one.
+		
+		@param inArgs: FetcherInArgs instance
+		@returns: FetcherOutArgs instance
+		@throws: HTTPFetcherError if the worker died during fetch
+		"""
+		key = None
+		if inArgs.options.reuseConnections:
+			key = connectionKey(inArgs.url, inArgs.platformPath)
+		worker = self._acquire(key)
+		try:
+			try:
+				outArgs = worker.fetch(inArgs)
+			except FetcherWorkerGone:
+				#died while idle, the request didn't get to it
+				logging.debug("Fetcher subprocess died while idle, respawning it")
+				worker = FetcherWorker()
+				outArgs = worker.fetch(inArgs)
+		except:
+			#worker is dead or out of sync with its frames, never reused
+			worker.kill()
+			raise
+		worker.lastKey = key
+		self._release(worker)
+		return outArgs
+	
+	def _acquire(self, key):
+		"""Return idle worker, preferring one whose last fetch was with
+		the same connection key, or spawn a new one. Workers that died
+		while idle are reaped.
+		"""
+		with self.lock:
+			dead = [worker for worker in self.idleWorkers if not worker.isAlive()]
+			for worker in dead:
+				self.idleWorkers.remove(worker)
+				worker.kill()
+			if key is not None:
+				for (idx, worker) in enumerate(self.idleWorkers):
+					if worker.lastKey == key:
+						return self.idleWorkers.pop(idx)
+			if self.idleWorkers:
+				return self.idleWorkers.pop()
+		return FetcherWorker()
+	
+	def _release(self, worker):
+		if self.maxFetches > 0 and worker.fetchCount >= self.maxFetches:
+			worker.close()
+		elif self.maxRSS > 0 and worker.rss > self.maxRSS:
+			logging.debug("Recycling fetcher subprocess with RSS %d MB", worker.rss)
+			worker.close()
+		else:
+			with self.lock:
+				self.idleWorkers.append(worker)
+	
+	def close(self):
+		"""Terminate all idle workers."""
+		with self.lock:
+			workers = self.idleWorkers
+			self.idleWorkers = []
+		for worker in workers:
+			worker.close()
+
 class HTTPFetcher(object):
 	"""Fetches HTTP(S) pages via PyCURL. CA certificates can be configured.
 	"""
 	
 	_headerRe = regex.compile(r"(?P<name>\S+?): (?P<value>.*?)\r\n")
 	
-	def __init__(self, platform, certPlatforms, fetchOptions, ruleTrie=None):
+	#pool of fetcher subprocesses shared among all fetchers and threads
+	_workerPool = None
+	_workerPoolLock = threading.Lock()
+	
+	def __init__(self, platform, certPlatforms, fetchOptions, ruleTrie=None, dnsCache=None,
+			latencyTracker=None):
 		"""Create fetcher that validates certificates using selected
 		platform.
 		
@@ -127,11 +533,18 @@ class HTTPFetcher(object):
 		for known platforms
 		@param ruleTrie: rules.RuleTrie to apply on URLs for following.
 		Set to None if redirects should not be rewritten
+		@param dnsCache: dns_cache.DNSCache whose addresses are passed to
+		libcurl, None to let libcurl resolve everything
+		@param latencyTracker: latency.LatencyTracker used for adaptive
+		timeouts and fast-fail of unreachable hosts, None for fixed timeouts
 		"""
+		self.platform = platform
 		self.platformPath = certPlatforms.getCAPath(platform)
 		self.certPlatforms = certPlatforms
 		self.options = fetchOptions
 		self.ruleTrie = ruleTrie
+		self.dnsCache = dnsCache
+		self.latencyTracker = latencyTracker
 	
 	def idnEncodedUrl(self, url):
 		"""Encodes URL so that IDN domains are punycode-escaped. Has no
@@ -177,92 +590,224 @@ class HTTPFetcher(object):
 		newUrl = urlparse.urlunparse(urlParts)
 		
 		return newUrl
+	
+	def resolveEntries(self, url, wait):
+		"""Return CURLOPT_RESOLVE entries for URL's host from DNS cache.
 		
+		@param url: IDNA-encoded URL
+		@param wait: wait for the host if it's being resolved right now
+		@returns: list of entries or None if there's nothing cached
+		@throws HTTPFetcherError: if host is known not to exist
+		"""
+		if self.dnsCache is None:
+			return None
+		p = urlparse.urlparse(url)
+		if p.hostname is None:
+			return None
+		if self.dnsCache.isDead(p.hostname, wait):
+			raise HTTPFetcherError("Non-existent domain '%s'" % p.hostname)
+		port = p.port or {"http": 80, "https": 443}.get(p.scheme)
+		return self.dnsCache.curlResolve(p.hostname, port)
+		
+	def requestOptions(self, url):
+		"""Return options for fetching URL - with timeouts derived from
+		latencies observed so far if there's a latency tracker.
+		
+		@param url: IDNA-encoded URL
+		@returns: FetchOptions instance
+		@throws HTTPFetcherError: if connecting to URL's host failed
+		earlier in this run
+		"""
+		tracker = self.latencyTracker
+		if tracker is None:
+			return self.options
+		
+		(host, port) = endpoint(url)
+		if tracker.hasFailed((host, port)):
+			raise HTTPFetcherError("Connecting to '%s' port %s failed earlier, not trying again" % \
+				(host, port))
+		
+		options = copy.copy(self.options)
+		(options.connectTimeout, options.readTimeout) = tracker.timeouts(host,
+			self.options.connectTimeout, self.options.readTimeout)
+		return options
+	
+	def recordFetch(self, url, timings, error=None):
+		"""Feed result of a fetch into latency tracker.
+		
+		@param url: IDNA-encoded URL that was fetched
+		@param timings: dict from curlTimings() or None
+		@param error: pycurl.error the fetch failed with or None
+		"""
+		tracker = self.latencyTracker
+		if tracker is None:
+			return
+		
+		(host, port) = endpoint(url)
+		if error is None:
+			if timings:
+				tracker.record(host, timings["connect"], timings["total"])
+			return
+		
+		errno = error.args and error.args[0]
+		connectTime = timings and timings.get("connect")
+		if errno == pycurl.E_COULDNT_CONNECT or \
+				(errno == pycurl.E_OPERATION_TIMEDOUT and not connectTime):
+			logging.debug("Connecting to %s port %s failed, further fetches fail fast",
+				host, port)
+			tracker.connectFailed((host, port))
+	
+	@staticmethod
+	def curlTimings(c):
+		"""Return dict with times of fetch done by PyCURL handle, in
+		seconds from start of the fetch until name was resolved
+		(namelookup), TCP connection established (connect), TLS handshake
+		done (appconnect, 0 for plain HTTP), first byte received
+		(starttransfer) and the fetch finished (total).
+		"""
+		return {
+			"namelookup": c.getinfo(pycurl.NAMELOOKUP_TIME),
+			"connect": c.getinfo(pycurl.CONNECT_TIME),
+			"appconnect": c.getinfo(pycurl.APPCONNECT_TIME),
+			"starttransfer": c.getinfo(pycurl.STARTTRANSFER_TIME),
+			"total": c.getinfo(pycurl.TOTAL_TIME),
+		}
+	
 	@staticmethod
-	def _doFetch(url, options, platformPath):
+	def _doFetch(url, options, platformPath, resolve=None):
 		"""
-		Fetch data from URL. If options.useSubprocess is True, spawn
-		subprocess for fetching.
+		Fetch data from URL. If options.useSubprocess is True, fetch
+		is done in one of the subprocesses from the worker pool. The
+		subprocess writes response body into a temporary file (in
+		/dev/shm if possible) that is mapped here, only small
+		FetcherOutArgs without body are pickled through the pipe.
 		
 		@see HTTPFetcher.staticFetch() for parameter description
 		
 		@throws: anything staticFetch() throws
+		@throws: pycurl.error if PyCURL failed in subprocess, with the
+		timings attribute set
 		@throws: HTTPFetcherError in case of problem in subprocess invocation
 		@throws: cPickle.UnpicklingError when we get garbage from subprocess
 		"""
 		if not options.useSubprocess:
-			return HTTPFetcher.staticFetch(url, options, platformPath)
-		
-		inArgs = FetcherInArgs(url, options, platformPath)
-		
-		# Workaround for cPickle seeing module name as __main__ if we
-		# just directly executed this script.
-		# TODO: check PYTHONPATH etc if not in the same dir as script
-		# TODO: we should set the main process to be session leader
-		trampoline = 'import http_client; http_client.subprocessFetch()'
+			return HTTPFetcher.staticFetch(url, options, platformPath, resolve=resolve)
 		
-		# Spawn subprocess, call this module as "main" program. I tried
-		# also using python's multiprocessing module, but for some
-		# reason it was a hog on CPU and RAM (maybe due to the queues?)
-		# Also, logging module didn't play along nicely.
-		args = [sys.executable, '-c', trampoline]
-		#logging.debug("Spawning subprocess with args %s", args)
-		p = subprocess.Popen(args, stdin=subprocess.PIPE,
-			stdout=subprocess.PIPE,	stderr=subprocess.PIPE)
-		
-		# Hopefully we shouldn't deadlock here: first all data is written
-		# to subprocess's stdin, it will unpickle them first. Then we
-		# wait for resulting pickled data from stdout. In case of trouble,
-		# try using big bufsize or bufsize=-1 in Popen invocation.
-		#
-		# Doc page for subprocess says "don't use communicate() with big
-		# or unlimited data", but doesn't say what is the alternative
-		(outData, errData) = p.communicate(cPickle.dumps(inArgs))
-		exitCode = p.wait()
-		
-		if exitCode != 0:
-			raise HTTPFetcherError("Subprocess failed with exit code %d" % exitCode)
+		(fd, bodyPath) = tempfile.mkstemp(prefix="fetch-", dir=_bodyFileDir)
+		os.close(fd)
+		try:
+			inArgs = FetcherInArgs(url, options, platformPath, bodyPath, resolve)
+			outArgs = HTTPFetcher.workerPool(options).fetch(inArgs)
 			
-		#logging.debug("Subprocess finished OK")
-		unpickled = cPickle.loads(outData)
-		if not isinstance(unpickled, FetcherOutArgs):
-			raise HTTPFetcherError("Unexpected datatype received from subprocess: %s" % \
-				type(unpickled))
-		if unpickled.errorStr: #chained exception tracebacks are bit ugly/long
-			raise HTTPFetcherError("Fetcher subprocess error: %s" % unpickled.errorStr)
+			if not isinstance(outArgs, FetcherOutArgs):
+				raise HTTPFetcherError("Unexpected datatype received from subprocess: %s" % \
+					type(outArgs))
+			if outArgs.curlErrno is not None:
+				error = pycurl.error(outArgs.curlErrno, outArgs.errorStr)
+				error.timings = outArgs.timings
+				raise error
+			if outArgs.errorStr: #chained exception tracebacks are bit ugly/long
+				raise HTTPFetcherError("Fetcher subprocess error: %s" % outArgs.errorStr)
+			
+			if outArgs.data is None:
+				startTime = time.time()
+				outArgs.data = readBodyFile(bodyPath)
+				if outArgs.timings is not None:
+					outArgs.timings["body_read"] = time.time() - startTime
+		finally:
+			os.unlink(bodyPath)
 			
-		return unpickled
+		return outArgs
+	
+	@staticmethod
+	def workerPool(options):
+		"""Return pool of fetcher subprocesses shared by all fetchers,
+		create it on first use.
 		
+		@param options: FetchOptions with limits for worker recycling
+		"""
+		with HTTPFetcher._workerPoolLock:
+			if HTTPFetcher._workerPool is None:
+				HTTPFetcher._workerPool = FetcherWorkerPool(
+					options.subprocessMaxFetches, options.subprocessMaxRSS)
+			return HTTPFetcher._workerPool
+	
 	@staticmethod
-	def staticFetch(url, options, platformPath):
+	def shutdownWorkerPool():
+		"""Terminate idle fetcher subprocesses, if any were started."""
+		with HTTPFetcher._workerPoolLock:
+			if HTTPFetcher._workerPool is not None:
+				HTTPFetcher._workerPool.close()
+				HTTPFetcher._workerPool = None
+		
+	@staticmethod
+	def newCurl(url, options, platformPath, writeFunction, headerFunction, handle=None,
+			resolve=None):
+		"""Construct a PyCURL object set up for fetching given URL.
+		
+		@param url: IDNA-encoded URL
+		@param options: FetchOptions instance
+		@param platformPath: directory with platform certificates
+		@param writeFunction: callback receiving chunks of body data
+		@param headerFunction: callback receiving header lines
+		@param handle: PyCURL handle with default options to be set up
+		instead of creating a new one
+		@param resolve: list of CURLOPT_RESOLVE entries or None
+		"""
+		c = handle or pycurl.Curl()
+		c.setopt(c.URL, url)
+		c.setopt(c.WRITEFUNCTION, writeFunction)
+		c.setopt(c.HEADERFUNCTION, headerFunction)
+		c.setopt(c.CONNECTTIMEOUT_MS, int(options.connectTimeout * 1000))
+		c.setopt(c.TIMEOUT_MS, int(options.readTimeout * 1000))
+		# Validation should not be disabled except for debugging
+		#c.setopt(c.SSL_VERIFYPEER, 0)
+		#c.setopt(c.SSL_VERIFYHOST, 0)
+		c.setopt(c.CAPATH, platformPath)
+		if options.userAgent:
+			c.setopt(c.USERAGENT, options.userAgent)
+		c.setopt(c.SSLVERSION, options.sslVersion)
+		c.setopt(c.VERBOSE, options.curlVerbose)
+		if resolve:
+			c.setopt(c.RESOLVE, resolve)
+		return c
+		
+	@staticmethod
+	def staticFetch(url, options, platformPath, bodyFile=None, resolve=None):
 		"""Construct a PyCURL object and fetch given URL.
 		
 		@param url: IDNA-encoded URL
 		@param options: FetchOptions instance
 		@param platformPath: directory with platform certificates
+		@param bodyFile: file opened for reading and writing; if given,
+		body is written into it and data of the result are None
+		@param resolve: list of CURLOPT_RESOLVE entries or None
 		@returns: FetcherOutArgs instance with fetched URL data
 		
-		@throws: anything PyCURL can throw (SSL error, timeout, etc.)
+		@throws: anything PyCURL can throw (SSL error, timeout, etc.);
+		pycurl.error has timings attribute set
 		"""
+		cache = HTTPFetcher.responseCache(options)
+		cached = cache and cache.lookup(url)
+		key = None
+		if options.reuseConnections:
+			key = connectionKey(url, platformPath)
+		buf = CappedBuffer(options.maxBodyBytes, bodyFile)
+		headerBuf = cStringIO.StringIO()
+		c = None
 		try:
-			buf = cStringIO.StringIO()
-			headerBuf = cStringIO.StringIO()
-			
-			c = pycurl.Curl()
-			c.setopt(c.URL, url)
-			c.setopt(c.WRITEFUNCTION, buf.write)
-			c.setopt(c.HEADERFUNCTION, headerBuf.write)
-			c.setopt(c.CONNECTTIMEOUT, options.connectTimeout)
-			c.setopt(c.TIMEOUT, options.readTimeout)
-			# Validation should not be disabled except for debugging
-			#c.setopt(c.SSL_VERIFYPEER, 0)
-			#c.setopt(c.SSL_VERIFYHOST, 0)
-			c.setopt(c.CAPATH, platformPath)
-			if options.userAgent:
-				c.setopt(c.USERAGENT, options.userAgent)
-			c.setopt(c.SSLVERSION, options.sslVersion)
-			c.setopt(c.VERBOSE, options.curlVerbose)
-			c.perform()
+			c = HTTPFetcher.newCurl(url, options, platformPath, buf.write, headerBuf.write,
+				key and _curlHandles.acquire(key), resolve)
+			if cached:
+				c.setopt(c.HTTPHEADER, cached.conditionalHeaders())
+			try:
+				c.perform()
+			except pycurl.error, e:
+				if not buf.truncated:
+					e.timings = HTTPFetcher.curlTimings(c)
+					raise
+				logging.debug("Body of %s exceeds %d bytes, truncated", url, options.maxBodyBytes)
+			timings = HTTPFetcher.curlTimings(c)
 			
 			bufValue = buf.getvalue()
 			headerStr = headerBuf.getvalue()
@@ -270,14 +815,88 @@ class HTTPFetcher(object):
 		finally:
 			buf.close()
 			headerBuf.close()
-			c.close()
+			if c and key:
+				_curlHandles.release(key, c)
+			elif c:
+				c.close()
 			
-		fetched = FetcherOutArgs(httpCode, bufValue, headerStr)
+		fetched = FetcherOutArgs(httpCode, bufValue, headerStr, truncated=buf.truncated,
+			timings=timings)
+		return HTTPFetcher.revalidated(cache, cached, url, fetched, bodyFile)
+	
+	@staticmethod
+	def responseCache(options):
+		"""Return ResponseCache configured in options or None if the
+		response cache is disabled.
+		"""
+		if not options.responseCacheDir:
+			return None
+		return ResponseCache(options.responseCacheDir,
+			options.responseCacheMaxSize * 1024 * 1024)
+	
+	@staticmethod
+	def revalidated(cache, cached, url, fetched, bodyFile=None):
+		"""Serve 304 Not Modified response from cache, store fresh 200
+		responses into it.
+		
+		@param cache: ResponseCache or None if cache is disabled
+		@param cached: CachedResponse whose validators were sent with the
+		request or None
+		@param url: IDNA-encoded URL that was fetched
+		@param fetched: FetcherOutArgs of the fetch
+		@param bodyFile: file with the body if staticFetch() wrote it there
+		@returns: FetcherOutArgs - the cached response for 304, otherwise
+		fetched
+		"""
+		if cache is None:
+			return fetched
+		if fetched.httpCode == 304 and cached:
+			logging.debug("Not modified, using cached response for %s", url)
+			if bodyFile:
+				bodyFile.seek(0)
+				bodyFile.truncate()
+				bodyFile.write(cached.data)
+				return FetcherOutArgs(cached.httpCode, None, cached.headerStr,
+					timings=fetched.timings)
+			return FetcherOutArgs(cached.httpCode, cached.data, cached.headerStr,
+				timings=fetched.timings)
+		if fetched.httpCode == 200 and not fetched.truncated:
+			headers = dict((name.lower(), value) for (name, value) in
+				HTTPFetcher._headerRe.findall(fetched.headerStr))
+			data = fetched.data
+			if data is None:
+				bodyFile.seek(0)
+				data = bodyFile.read()
+			cache.store(url, fetched.httpCode, data, headers, fetched.headerStr)
 		return fetched
 	
+	def fetchPage(self, url):
+		"""Fetch given http/https URL. Return codes 301 and 302 are
+		followed, URLs rewritten using HTTPS Everywhere rules.
+		
+		@param url: string URL of http(s) resource
+		@returns: FetcherOutArgs of the last fetch in redirect chain
+		
+		@throws pycurl.error: on failed fetch
+		@throws HTTPFetcherError: on failed fetch/redirection
+		"""
+		follower = RedirectFollower(self, url)
+		
+		while True:
+			(newUrl, platformPath) = follower.nextRequest()
+			resolve = self.resolveEntries(newUrl, True)
+			options = self.requestOptions(newUrl)
+			try:
+				fetched = HTTPFetcher._doFetch(newUrl, options, platformPath, resolve)
+			except pycurl.error, e:
+				self.recordFetch(newUrl, getattr(e, "timings", None), e)
+				raise
+			self.recordFetch(newUrl, fetched.timings)
+			if follower.handleResponse(fetched) is not None:
+				return fetched
+	
 	def fetchHtml(self, url):
-		"""Fetch HTML from given http/https URL. Return codes 301 and
-		302 are followed, URLs rewritten using HTTPS Everywhere rules.
+		"""Fetch HTML from given http/https URL, same as fetchPage().
 		
 		@param url: string URL of http(s) resource
 		@returns: tuple (httpResponseCode, htmlData)
@@ -285,87 +904,289 @@ class HTTPFetcher(object):
 		@throws pycurl.error: on failed fetch
 		@throws HTTPFetcherError: on failed fetch/redirection
 		"""
-		newUrl = url
+		fetched = self.fetchPage(url)
+		return (fetched.httpCode, fetched.data)
+
+
+class RedirectFollower(object):
+	"""State of fetching one URL with HTTPFetcher - follows 301/302
+	redirects and rewrites them using HTTPS Everywhere rules. The actual
+	fetches are left to the caller, so the same logic serves blocking
+	HTTPFetcher.fetchPage as well as MultiFetcher continuations.
+	"""
+	
+	def __init__(self, fetcher, url):
+		"""
+		@param fetcher: HTTPFetcher whose platform, options and rule
+		trie are used
+		@param url: string URL of http(s) resource
+		"""
+		self.fetcher = fetcher
+		self.url = url
+		self.newUrl = url
 		#While going through 301/302 redirects we might encounter URL
 		#that was rewritten using different platform and need to use
 		#that platform's certs for the next fetch.
-		newUrlPlatformPath = self.platformPath
-		
+		self.newUrlPlatformPath = fetcher.platformPath
 		#set of URLs seen in redirects for cycle detection
-		seenUrls = set()
+		self.seenUrls = set()
+		self.depth = 0
+		#(URL, HTTP code, timings) tuples of fetches done so far
+		self.chain = []
+	
+	def nextRequest(self):
+		"""Return parameters for next fetch in the redirect chain.
 		
-		options = self.options
+		@returns: tuple (IDNA-encoded URL, platformPath)
+		@throws HTTPFetcherError: when redirect depth was exceeded
+		"""
+		options = self.fetcher.options
 		
-		#handle 301/302 redirects while also rewriting them with HTE rules
 		#limit redirect depth
-		for depth in range(options.redirectDepth):
-			newUrl = self.idnEncodedUrl(newUrl)
-			seenUrls.add(newUrl)
-			
-			#override platform path detected from ruleset files
-			if options.staticCAPath:
-				newUrlPlatformPath = options.staticCAPath
-				
-			fetched = HTTPFetcher._doFetch(newUrl, options, newUrlPlatformPath)
+		if self.depth >= options.redirectDepth:
+			raise HTTPFetcherError("Too many redirects while fetching '%s'" % self.url)
+		self.depth += 1
+		
+		self.newUrl = self.fetcher.idnEncodedUrl(self.newUrl)
+		self.seenUrls.add(self.newUrl)
+		
+		#override platform path detected from ruleset files
+		if options.staticCAPath:
+			self.newUrlPlatformPath = options.staticCAPath
+		
+		return (self.newUrl, self.newUrlPlatformPath)
+	
+	def handleResponse(self, fetched):
+		"""Process result of fetch requested by last nextRequest().
+		301/302 redirects are rewritten with HTTPS Everywhere rules.
+		
+		@param fetched: FetcherOutArgs instance
+		@returns: fetched if this was the last fetch, None if redirect
+		should be followed by another nextRequest()
+		@throws HTTPFetcherError: on failed fetch/redirection
+		"""
+		fetcher = self.fetcher
+		newUrl = self.newUrl
+		
+		httpCode = fetched.httpCode
+		headerStr = fetched.headerStr
+		self.chain.append((newUrl, httpCode, fetched.timings))
+		
+		#shitty HTTP header parsing
+		if httpCode == 0:
+			raise HTTPFetcherError("Pycurl fetch failed for '%s'" % newUrl)
+		elif httpCode in (301, 302):
+			#'Location' should be present only once, so the dict won't hurt
+			headers = dict(fetcher._headerRe.findall(headerStr))
+			location = headers.get('Location')
+			if not location:
+				raise HTTPFetcherError("Redirect for '%s' missing Location" % newUrl)
 			
-			httpCode = fetched.httpCode
-			bufValue = fetched.data
-			headerStr = fetched.headerStr
+			location = fetcher.absolutizeUrl(newUrl, location)
+			logging.debug("Following redirect %s => %s", newUrl, location)
 			
-			#shitty HTTP header parsing
-			if httpCode == 0:
-				raise HTTPFetcherError("Pycurl fetch failed for '%s'" % newUrl)
-			elif httpCode in (301, 302):
-				#'Location' should be present only once, so the dict won't hurt
-				headers = dict(self._headerRe.findall(headerStr))
-				location = headers.get('Location')
-				if not location:
-					raise HTTPFetcherError("Redirect for '%s' missing Location" % newUrl)
-				
-				location = self.absolutizeUrl(newUrl, location)
-				logging.debug("Following redirect %s => %s", newUrl, location)
+			if fetcher.ruleTrie:
+				ruleMatch = fetcher.ruleTrie.transformUrl(location)
+				newUrl = ruleMatch.url
 				
-				if self.ruleTrie:
-					ruleMatch = self.ruleTrie.transformUrl(location)
-					newUrl = ruleMatch.url
-					
-					#Platform for cert validation might have changed.
-					#Record CA path for the platform or reset if not known.
-					#Not really sure fallback to first CA platform is always
-					#correct, but it's expected that the platforms would be
-					#same as the originating site.
-					if ruleMatch.ruleset:
-						newUrlPlatformPath = self.certPlatforms.getCAPath(ruleMatch.ruleset.platform)
-					else:
-						newUrlPlatformPath = self.platformPath
-						
-					if newUrl != location:
-						logging.debug("Redirect rewritten: %s => %s", location, newUrl)
+				#Platform for cert validation might have changed.
+				#Record CA path for the platform or reset if not known.
+				#Not really sure fallback to first CA platform is always
+				#correct, but it's expected that the platforms would be
+				#same as the originating site.
+				if ruleMatch.ruleset:
+					self.newUrlPlatformPath = fetcher.certPlatforms.getCAPath(ruleMatch.ruleset.platform)
 				else:
-					newUrl = location
-			
-				if newUrl in seenUrls:
-					raise HTTPFetcherError("Cycle detected - URL already encountered: %s" % newUrl)
-				
-				continue #fetch redirected location
-				
-			return (httpCode, bufValue)
+					self.newUrlPlatformPath = fetcher.platformPath
+					
+				if newUrl != location:
+					logging.debug("Redirect rewritten: %s => %s", location, newUrl)
+			else:
+				newUrl = location
+		
+			if newUrl in self.seenUrls:
+				raise HTTPFetcherError("Cycle detected - URL already encountered: %s" % newUrl)
 			
-		raise HTTPFetcherError("Too many redirects while fetching '%s'" % url)
+			self.newUrl = newUrl
+			return None #fetch redirected location
+		
+		fetched.chain = self.chain
+		return fetched
 
 
-def subprocessFetch():
+class MultiFetcher(object):
+	"""Asynchronous fetch engine driving many transfers from a single
+	thread via pycurl.CurlMulti. Redirects are followed as continuations
+	of finished transfers, no thread blocks on any single fetch.
+	
+	Fetches are done in-process, the fetch_in_subprocess option does not
+	apply here. Connections are reused through CurlMulti's own connection
+	cache, so reuse_connections does not apply either.
 	"""
-	Used for invocation in fetcher subprocess. Reads cPickled FetcherInArgs
-	from stdin and write FetcherOutArgs to stdout. Implementation of the
-	subprocess URL fetch.
+	
+	def __init__(self, maxTransfers):
+		"""
+		@param maxTransfers: max number of concurrently running
+		transfers, further fetches wait for a free slot
+		"""
+		self.maxTransfers = maxTransfers
+		self.multi = pycurl.CurlMulti()
+		#(RedirectFollower, callback) tuples waiting for free slot
+		self.waiting = collections.deque()
+		#maps running Curl handles to _MultiTransfer objects
+		self.transfers = {}
+	
+	def add(self, fetcher, url, callback):
+		"""Schedule fetch of URL. Semantics are same as with
+		fetcher.fetchPage(url), i.e. redirects are followed and rewritten.
+		
+		@param fetcher: HTTPFetcher instance whose settings are used
+		@param url: string URL of http(s) resource
+		@param callback: called from perform() as callback(result, error)
+		when fetch finishes. Result is FetcherOutArgs of the last fetch on
+		success, otherwise error contains the exception.
+		"""
+		self.waiting.append((RedirectFollower(fetcher, url), callback))
+	
+	def activeCount(self):
+		"""Return number of unfinished fetches (running or waiting)."""
+		return len(self.transfers) + len(self.waiting)
+	
+	def perform(self, timeout=1.0):
+		"""Wait at most timeout seconds for network activity, advance
+		all transfers and invoke callbacks of finished fetches.
+		"""
+		self._startWaiting()
+		if not self.transfers:
+			return
+		
+		self._wait(timeout)
+		
+		while True:
+			(ret, numHandles) = self.multi.perform()
+			if ret != pycurl.E_CALL_MULTI_PERFORM:
+				break
+		
+		while True:
+			(numQueued, okList, errList) = self.multi.info_read()
+			for c in okList:
+				self._transferDone(c, None)
+			for (c, errno, errmsg) in errList:
+				self._transferDone(c, pycurl.error(errno, errmsg))
+			if numQueued == 0:
+				break
+		
+		self._startWaiting()
+	
+	def _wait(self, timeout):
+		"""Wait for socket activity or libcurl's timer. CurlMulti.select
+		returns immediately if libcurl has no sockets to wait on (e.g.
+		while resolving), so sleep a bit in such case to avoid spinning.
+		"""
+		curlTimeout = self.multi.timeout()
+		if curlTimeout >= 0:
+			timeout = min(timeout, curlTimeout/1000.0)
+		
+		start = time.time()
+		if self.multi.select(timeout) <= 0:
+			remaining = timeout - (time.time() - start)
+			if remaining > 0:
+				time.sleep(min(remaining, 0.1))
+	
+	def _startWaiting(self):
+		while self.waiting and len(self.transfers) < self.maxTransfers:
+			(follower, callback) = self.waiting.popleft()
+			self._startTransfer(follower, callback)
+	
+	def _startTransfer(self, follower, callback):
+		"""Start next fetch in follower's redirect chain."""
+		transfer = _MultiTransfer(follower, callback, follower.fetcher.options.maxBodyBytes)
+		try:
+			(url, platformPath) = follower.nextRequest()
+			options = follower.fetcher.requestOptions(url)
+			resolve = follower.fetcher.resolveEntries(url, False)
+			c = HTTPFetcher.newCurl(url, options, platformPath,
+				transfer.buf.write, transfer.headerBuf.write, resolve=resolve)
+			transfer.cache = HTTPFetcher.responseCache(options)
+			transfer.cached = transfer.cache and transfer.cache.lookup(url)
+			transfer.url = url
+			if transfer.cached:
+				c.setopt(c.HTTPHEADER, transfer.cached.conditionalHeaders())
+		except Exception, e:
+			transfer.close()
+			callback(None, e)
+			return
+		
+		self.transfers[c] = transfer
+		self.multi.add_handle(c)
+	
+	def _transferDone(self, c, error):
+		transfer = self.transfers.pop(c)
+		self.multi.remove_handle(c)
+		
+		try:
+			timings = HTTPFetcher.curlTimings(c)
+			if error and not transfer.buf.truncated:
+				transfer.follower.fetcher.recordFetch(transfer.url, timings, error)
+				raise error
+			transfer.follower.fetcher.recordFetch(transfer.url, timings)
+			fetched = FetcherOutArgs(c.getinfo(pycurl.HTTP_CODE),
+				transfer.buf.getvalue(), transfer.headerBuf.getvalue(),
+				truncated=transfer.buf.truncated, timings=timings)
+			fetched = HTTPFetcher.revalidated(transfer.cache, transfer.cached,
+				transfer.url, fetched)
+			result = transfer.follower.handleResponse(fetched)
+		except Exception, e:
+			transfer.callback(None, e)
+			return
+		finally:
+			transfer.close()
+			c.close()
+		
+		if result is None: #continue with redirected location
+			self._startTransfer(transfer.follower, transfer.callback)
+		else:
+			transfer.callback(result, None)
+
+class _MultiTransfer(object):
+	"""Buffers and continuation of one running MultiFetcher transfer."""
+	
+	def __init__(self, follower, callback, maxBodyBytes):
+		self.follower = follower
+		self.callback = callback
+		self.buf = CappedBuffer(maxBodyBytes)
+		self.headerBuf = cStringIO.StringIO()
+		#response cache, cached response being revalidated and fetched URL
+		self.cache = None
+		self.cached = None
+		self.url = None
+	
+	def close(self):
+		self.buf.close()
+		self.headerBuf.close()
+
+
+def subprocessFetch(inArgs):
+	"""
+	Implementation of the subprocess URL fetch.
+	
+	@param inArgs: FetcherInArgs instance
+	@returns: FetcherOutArgs with fetched data or errorStr set
 	"""
 	outArgs = None
 	
 	try:
-		inArgs = cPickle.load(sys.stdin)
 		inArgs.check()
-		outArgs = HTTPFetcher.staticFetch(inArgs.url, inArgs.options, inArgs.platformPath)
+		if inArgs.bodyPath:
+			with open(inArgs.bodyPath, "w+b") as bodyFile:
+				outArgs = HTTPFetcher.staticFetch(inArgs.url, inArgs.options,
+					inArgs.platformPath, bodyFile, inArgs.resolve)
+		else:
+			outArgs = HTTPFetcher.staticFetch(inArgs.url, inArgs.options,
+				inArgs.platformPath, resolve=inArgs.resolve)
+	except pycurl.error, e:
+		outArgs = FetcherOutArgs(errorStr=str(e.args[1]), curlErrno=e.args[0],
+			timings=getattr(e, "timings", None))
 	except:
 		errorStr = traceback.format_exc()
 		outArgs = FetcherOutArgs(errorStr=errorStr)
@@ -375,7 +1196,35 @@ def subprocessFetch():
 			HTTPFetcherError("Subprocess logic error - no output args"))
 		outArgs = FetcherOutArgs(errorStr=errorStr)
 	
-	try:
-		cPickle.dump(outArgs, sys.stdout)
-	except:
-		cPickle.dump(None, sys.stdout) #catch-all case
+	return outArgs
+
+def subprocessFetchLoop():
+	"""
+	Used for invocation in fetcher subprocess. Reads framed cPickled
+	FetcherInArgs from stdin and writes framed (FetcherOutArgs, RSS)
+	tuples to stdout until stdin is closed.
+	"""
+	inFile = sys.stdin
+	outFile = sys.stdout
+	#anything printed by accident must not corrupt the frames
+	sys.stdout = sys.stderr
+	#Ctrl-C goes to the whole process group, but the parent decides whether
+	#to finish running fetches; we exit when it closes our stdin
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	
+	while True:
+		frame = readFrame(inFile)
+		if frame is None:
+			break
+		
+		try:
+			inArgs = cPickle.loads(frame)
+			outArgs = subprocessFetch(inArgs)
+		except:
+			outArgs = FetcherOutArgs(errorStr=traceback.format_exc())
+		
+		try:
+			data = cPickle.dumps((outArgs, currentRSS()), cPickle.HIGHEST_PROTOCOL)
+		except:
+			data = cPickle.dumps((None, currentRSS())) #catch-all case
+		writeFrame(outFile, data)
@@ -0,0 +1,111 @@
+import os
+import time
+import threading
+
+class Journal(object):
+	"""Append-only journal of completed comparisons, so that an interrupted
+	run can be resumed without redoing them. Each line has tab-separated
+	plain URL, transformed URL and status of the result. Lines are
+	written and fsync'd in batches - a crash loses at most the last batch,
+	which is then simply checked again. Other result sinks are synced
+	before each batch, so the journal never vouches for results that
+	were not stored yet.
+
+	Results with error status are not journaled, resumed run tries them
+	again (they are often caused by the very network problem that
+	interrupted the run).
+	"""
+
+	def __init__(self, fname, resume, syncRecords=100, syncInterval=5.0, sinks=()):
+		"""Open the journal.
+
+		@param fname: path to journal file
+		@param resume: if True, load pairs completed by previous run and
+		append to the journal, otherwise start a new one
+		@param syncRecords: number of records after which the journal is
+		fsync'd
+		@param syncInterval: seconds after which records are fsync'd even
+		if there are fewer than syncRecords of them
+		@param sinks: result sinks whose sync() is called before records
+		are written to the journal
+		"""
+		self.fname = fname
+		self.syncRecords = syncRecords
+		self.syncInterval = syncInterval
+		self.sinks = sinks
+		#reentrant, close() may be called from signal handler
+		self.lock = threading.RLock()
+		#set of (plain URL, transformed URL) tuples of completed pairs
+		self.completed = set()
+		#lines of records not written yet
+		self.unsynced = []
+		self.lastSync = time.time()
+
+		if resume and os.path.exists(fname):
+			self._load()
+			self.f = open(fname, "ab")
+		else:
+			self.f = open(fname, "wb")
+		self.resumedCount = len(self.completed)
+
+	def _load(self):
+		validSize = 0
+		with open(self.fname, "rb") as f:
+			for line in f:
+				if not line.endswith("\n"):
+					break #torn write of the last record
+				parts = line[:-1].split("\t")
+				if len(parts) >= 2:
+					self.completed.add((parts[0], parts[1]))
+				validSize += len(line)
+
+		#drop torn record, so that next record starts on a new line
+		if os.path.getsize(self.fname) != validSize:
+			with open(self.fname, "r+b") as f:
+				f.truncate(validSize)
+
+	def isCompleted(self, plainUrl, transformedUrl):
+		"""Returns True iff the pair was completed by resumed run."""
+		return (plainUrl, transformedUrl) in self.completed
+
+	def record(self, result):
+		"""Append completed comparison to the journal.
+
+		@param result: check_rules.ComparisonResult
+		"""
+		if result.status == "error":
+			return
+
+		task = result.task
+		with self.lock:
+			self.unsynced.append("%s\t%s\t%s\n" % (task.plainUrl, task.transformedUrl,
+				result.status))
+			if len(self.unsynced) >= self.syncRecords or \
+					time.time() - self.lastSync >= self.syncInterval:
+				self._sync()
+
+	def syncIfDue(self):
+		"""Sync records older than syncInterval, called periodically so
+		that they don't wait for the next record during a quiet tail of
+		the run.
+		"""
+		with self.lock:
+			if self.unsynced and time.time() - self.lastSync >= self.syncInterval:
+				self._sync()
+
+	def _sync(self):
+		for sink in self.sinks:
+			sink.sync()
+		self.f.write("".join(self.unsynced))
+		self.f.flush()
+		os.fsync(self.f.fileno())
+		self.unsynced = []
+		self.lastSync = time.time()
+
+	def close(self):
+		"""Sync outstanding records and close the journal."""
+		with self.lock:
+			if self.f.closed:
+				return
+			self._sync()
+			self.f.close()
@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import logging
+import threading
+import Queue
+
+def chainRecord(chain):
+	"""Convert redirect chain of a fetch to list of dicts for JSON.
+
+	@param chain: list of (URL, HTTP code, timings) tuples or None
+	"""
+	if not chain:
+		return []
+	return [{"url": url, "code": httpCode, "timings": timings}
+		for (url, httpCode, timings) in chain]
+
+def chainTimings(chain):
+	"""Return dict with durations of fetch phases summed over all fetches
+	of redirect chain, None if there are no timings.
+	"""
+	totals = {}
+	for (url, httpCode, timings) in chain or ():
+		for (phase, duration) in (timings or {}).iteritems():
+			totals[phase] = totals.get(phase, 0.0) + duration
+	return totals or None
+
+def resultRecord(result, metricName):
+	"""Convert ComparisonResult to dict for JSON serialization.
+
+	@param result: check_rules.ComparisonResult
+	@param metricName: name of the metric distance was computed with
+	"""
+	task = result.task
+	return {
+		"rule_file": task.ruleFname,
+		"plain_url": task.plainUrl,
+		"transformed_url": task.transformedUrl,
+		"status": result.status,
+		"plain_code": result.plainRcode,
+		"transformed_code": result.transformedRcode,
+		"distance": result.distance,
+		"metric": metricName,
+		"error": result.errorStr,
+		"error_class": result.errorClass,
+		"attempts": result.attempts,
+		"plain_redirects": chainRecord(result.plainChain),
+		"transformed_redirects": chainRecord(result.transformedChain),
+		"timings": {
+			"plain": chainTimings(result.plainChain),
+			"transformed": chainTimings(result.transformedChain),
+			"metric": result.metricTimings,
+		},
+		"finished": time.time(),
+	}
+
+class JSONLinesSink(threading.Thread):
+	"""Result sink writing one JSON object per comparison to a JSON Lines
+	file. Records are serialized and written by this thread through a
+	large buffer, so comparison threads only enqueue them. The buffer is
+	flushed whenever the queue runs empty, records reach the disk on
+	sync().
+	"""
+
+	#size of write buffer in bytes
+	bufferSize = 1 << 20
+
+	def __init__(self, fname, metricName, append=False):
+		"""
+		@param fname: path to output file
+		@param metricName: name of the metric recorded with distances
+		@param append: append to existing file instead of overwriting it
+		"""
+		self.fname = fname
+		self.metricName = metricName
+		self.f = open(fname, append and "ab" or "wb", self.bufferSize)
+		self.queue = Queue.Queue()
+		self.writtenCount = 0
+		threading.Thread.__init__(self)
+		self.setDaemon(True)
+
+	def record(self, result):
+		"""Enqueue result of comparison for writing.
+
+		@param result: check_rules.ComparisonResult
+		"""
+		self.queue.put(resultRecord(result, self.metricName))
+
+	def run(self):
+		while True:
+			record = self.queue.get()
+			if record is None:
+				break
+			if isinstance(record, threading._Event):
+				#sync() waits for records enqueued before it
+				try:
+					self.f.flush()
+					os.fsync(self.f.fileno())
+				except Exception, e:
+					logging.exception("Failed to sync result records: %s", e)
+				record.set()
+				continue
+			try:
+				self.f.write(json.dumps(record, sort_keys=True) + "\n")
+				self.writtenCount += 1
+				if self.queue.empty():
+					self.f.flush()
+			except Exception, e:
+				logging.exception("Failed to write result record: %s", e)
+
+		self.f.close()
+
+	def sync(self, timeout=60.0):
+		"""Wait until enqueued records are written and fsync'd.
+
+		@param timeout: max seconds to wait
+		"""
+		if not self.isAlive():
+			return
+		synced = threading.Event()
+		self.queue.put(synced)
+		synced.wait(timeout)
+
+	def close(self):
+		"""Write enqueued records and close the file."""
+		self.queue.put(None)
+		self.join()
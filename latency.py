@@ -0,0 +1,118 @@
+import math
+import urlparse
+import threading
+import collections
+
+def percentile(samples, fraction):
+	"""Return nearest-rank percentile of samples.
+
+	@param samples: non-empty iterable of numbers
+	@param fraction: percentile as fraction, e.g. 0.95
+	"""
+	ordered = sorted(samples)
+	rank = int(math.ceil(fraction * len(ordered))) - 1
+	return ordered[max(0, min(rank, len(ordered) - 1))]
+
+def endpoint(url):
+	"""Return (host, port) tuple of URL, port defaults to the one of its
+	scheme. Connect failures are tracked per endpoint, since many hosts
+	listen on port 80 but not on 443.
+	"""
+	p = urlparse.urlparse(url)
+	return (p.hostname, p.port or {"http": 80, "https": 443}.get(p.scheme))
+
+class LatencyTracker(object):
+	"""Tracks connect and total times of fetches per host and globally
+	during a run, and derives timeouts for next fetches from them.
+	Endpoints (host and port) that failed to connect are remembered so
+	that their next fetches can fail fast.
+	"""
+
+	#timeout is this multiple of the 95th percentile of observed times
+	factor = 4.0
+	#min number of samples for host's own percentile, global is used before
+	minHostSamples = 3
+	#min number of samples for global percentile, defaults are used before
+	minGlobalSamples = 20
+	#number of most recent samples kept per host and globally
+	hostWindow = 50
+	globalWindow = 1000
+
+	def __init__(self, floor, ceiling):
+		"""
+		@param floor: min derived timeout in seconds
+		@param ceiling: max derived timeout in seconds
+		"""
+		self.floor = floor
+		self.ceiling = ceiling
+		self.lock = threading.Lock()
+		#maps host to deque of (connect time, total time) tuples
+		self.hostSamples = {}
+		self.globalSamples = collections.deque(maxlen=self.globalWindow)
+		#set of (host, port) tuples from endpoint()
+		self.failedEndpoints = set()
+
+	def record(self, host, connectTime, totalTime):
+		"""Record times of successful fetch from host (in seconds)."""
+		with self.lock:
+			samples = self.hostSamples.get(host)
+			if samples is None:
+				samples = self.hostSamples[host] = collections.deque(maxlen=self.hostWindow)
+			samples.append((connectTime, totalTime))
+			self.globalSamples.append((connectTime, totalTime))
+
+	def connectFailed(self, hostPort):
+		"""Remember that connecting to endpoint failed.
+
+		@param hostPort: (host, port) tuple from endpoint()
+		"""
+		with self.lock:
+			self.failedEndpoints.add(hostPort)
+
+	def forgetFailure(self, hostPort):
+		"""Allow connecting to endpoint again, e.g. when retrying its fetch."""
+		with self.lock:
+			self.failedEndpoints.discard(hostPort)
+
+	def hasFailed(self, hostPort):
+		"""Returns True iff connecting to endpoint failed earlier."""
+		with self.lock:
+			return hostPort in self.failedEndpoints
+
+	def timeouts(self, host, defaultConnect, defaultTotal):
+		"""Return timeouts for next fetch from host, derived from host's
+		own samples if there are enough of them, otherwise from global
+		samples, clamped to floor and ceiling.
+
+		@param host: hostname
+		@param defaultConnect: connect timeout used without enough samples
+		@param defaultTotal: total timeout used without enough samples
+		@returns: tuple (connect timeout, total timeout) in seconds
+		"""
+		with self.lock:
+			samples = self.hostSamples.get(host)
+			if samples is None or len(samples) < self.minHostSamples:
+				samples = self.globalSamples
+			if len(samples) < self.minGlobalSamples and samples is self.globalSamples:
+				return (defaultConnect, defaultTotal)
+			samples = list(samples)
+
+		connectTimeout = self._clamp(self.factor * percentile([s[0] for s in samples], 0.95))
+		totalTimeout = self._clamp(self.factor * percentile([s[1] for s in samples], 0.95))
+		return (connectTimeout, max(connectTimeout, totalTimeout))
+
+	def _clamp(self, timeout):
+		return min(self.ceiling, max(self.floor, timeout))
+
+	def stats(self):
+		"""Return string with global latency percentiles for logging."""
+		with self.lock:
+			samples = list(self.globalSamples)
+			failedCount = len(self.failedEndpoints)
+		if not samples:
+			return "no samples, endpoints failed to connect: %d" % failedCount
+		connectTimes = [s[0] for s in samples]
+		totalTimes = [s[1] for s in samples]
+		return "connect p50 %.3fs p95 %.3fs, total p50 %.3fs p95 %.3fs, endpoints failed to connect: %d" % \
+			(percentile(connectTimes, 0.5), percentile(connectTimes, 0.95),
+			percentile(totalTimes, 0.5), percentile(totalTimes, 0.95), failedCount)
@@ -0,0 +1,65 @@
+import threading
+import collections
+
+class LRUCache(object):
+	"""Bounded thread-safe mapping that evicts least recently used items.
+
+	Every clear() starts a new "generation" of the cache. Callers that
+	compute a value outside of the cache's lock should read the
+	generation before computing and pass it to put(), so that a value
+	computed from data that changed meanwhile is not stored.
+	"""
+
+	def __init__(self, maxSize):
+		"""
+		@param maxSize: max number of items kept in cache
+		"""
+		self.maxSize = maxSize
+		self.items = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.generation = 0
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key, default=None):
+		"""Return cached value for key or default if not cached."""
+		with self.lock:
+			try:
+				value = self.items.pop(key)
+			except KeyError:
+				self.misses += 1
+				return default
+
+			self.items[key] = value #move to most recently used
+			self.hits += 1
+			return value
+
+	def put(self, key, value, generation=None):
+		"""Store value for key, evicting least recently used item if
+		the cache is full.
+
+		@param generation: if not None, value is stored only if the
+		cache was not cleared since this generation was read
+		"""
+		with self.lock:
+			if generation is not None and generation != self.generation:
+				return
+			self.items.pop(key, None)
+			self.items[key] = value
+			if len(self.items) > self.maxSize:
+				self.items.popitem(last=False)
+
+	def clear(self):
+		"""Drop all items and start new generation."""
+		with self.lock:
+			self.items.clear()
+			self.generation += 1
+
+	def __len__(self):
+		return len(self.items)
+
+	def stats(self):
+		"""Return string with hit/miss counters for logging."""
+		total = self.hits + self.misses
+		ratio = total and 100.0 * self.hits / total or 0.0
+		return "hits %d, misses %d (%.1f%% hit ratio)" % (self.hits, self.misses, ratio)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+# Merges result databases of sharded runs (check_rules.py --shard i/N with
+# [state] dbfile per shard, e.g. dbfile = state-%(shard_index)s.sqlite) into
+# one report. If a URL pair was checked by more shards, the latest result wins.
+#
+# Usage: merge_results.py [-o merged.sqlite] [--all] shard.sqlite...
+#
+# The report has tab-separated rule file name, status, plain URL, rewritten
+# URL, HTTP codes of both pages, distance and error of each problematic (not
+# "ok") result, or of every result with --all. Counts of results by status are
+# printed to stderr.
+
+import sys
+import os
+import argparse
+import tempfile
+
+from state_store import StateStore
+
+def formatValue(value):
+	if value is None:
+		return "-"
+	if isinstance(value, float):
+		return "%.4f" % value
+	if isinstance(value, unicode):
+		value = value.encode("utf-8")
+	return str(value).replace("\t", " ").replace("\n", " ")
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Merge result databases of "
+		"sharded check_rules.py runs into one report.")
+	parser.add_argument("shards", metavar="shard.sqlite", nargs="+",
+		help="state database of a shard")
+	parser.add_argument("-o", "--output", metavar="DB",
+		help="also write merged results to this state database")
+	parser.add_argument("--all", action="store_true",
+		help="report all results, not only problematic ones")
+	args = parser.parse_args()
+
+	tmpFname = None
+	if args.output:
+		merged = StateStore(args.output)
+	else:
+		(fd, tmpFname) = tempfile.mkstemp(suffix=".sqlite")
+		os.close(fd)
+		merged = StateStore(tmpFname)
+
+	try:
+		for shardFname in args.shards:
+			if not os.path.exists(shardFname):
+				parser.error("No such file: %s" % shardFname)
+			count = merged.merge(shardFname)
+			sys.stderr.write("Merged %d results from %s\n" % (count, shardFname))
+
+		statusCounts = {}
+		for row in merged.results():
+			status = row["status"]
+			statusCounts[status] = statusCounts.get(status, 0) + 1
+			if status == "ok" and not args.all:
+				continue
+			sys.stdout.write("\t".join(formatValue(row[column]) for column in
+				("rule_fname", "status", "plain_url", "transformed_url", "plain_code",
+				"transformed_code", "distance", "error")) + "\n")
+
+		for (status, count) in sorted(statusCounts.items()):
+			sys.stderr.write("%s: %d\n" % (status, count))
+	finally:
+		merged.close()
+		if tmpFname:
+			os.unlink(tmpFname)
@@ -4,6 +4,7 @@
 from lxml import etree
 from cStringIO import StringIO
 
+import time
 import struct
 import bsdiff
 import Levenshtein
@@ -14,9 +15,12 @@ class Metric(object):
 	def __init__(self):
 		pass
 	
-	def distanceNormed(self, s1, s2):
+	def distanceNormed(self, s1, s2, timings=None):
 		"""Return float distance metric of two strings s1 and s2 in
 		range [0, 1].
+		
+		@param timings: optional dict that gets durations of computation
+		phases in seconds - "parse" (if documents are parsed) and "distance"
 		"""
 		raise NotImlementedError()
 	
@@ -26,10 +30,11 @@ class BSDiffMetric(Metric):
 	def __init__(self):
 		Metric.__init__(self)
 	
-	def distanceNormed(self, s1, s2):
+	def distanceNormed(self, s1, s2, timings=None):
 		if len(s1) == 0 and len(s2) == 0:
 			return 0
 		
+		startTime = time.time()
 		#bsdiff is not symmetric, so take max from both diffs
 		control, diffBlock, extra = bsdiff.Diff(s1, s2)
 		extraRatio1 = float(len(extra))/float(max(len(s1), len(s2)))
@@ -37,6 +42,8 @@ class BSDiffMetric(Metric):
 		control, diffBlock, extra = bsdiff.Diff(s2, s1)
 		extraRatio2 = float(len(extra))/float(max(len(s1), len(s2)))
 		
+		if timings is not None:
+			timings["distance"] = time.time() - startTime
 		return max(extraRatio1, extraRatio2)
 
 class MarkupMetric(Metric):
@@ -93,7 +100,7 @@ class MarkupMetric(Metric):
 		
 		return (self.mapTree(doc1, tagToCharMap), self.mapTree(doc2, tagToCharMap))
 	
-	def distanceNormed(self, s1, s2):
+	def distanceNormed(self, s1, s2, timings=None):
 		"""
 		"""
 		#Empty strings are not proper HTML/XML, but we can consider them
@@ -101,10 +108,16 @@ class MarkupMetric(Metric):
 		if len(s1) == 0 and len(s2) == 0:
 			return 0
 		
+		startTime = time.time()
 		doc1 = etree.parse(StringIO(s1), etree.HTMLParser())
 		doc2 = etree.parse(StringIO(s2), etree.HTMLParser())
+		parsedTime = time.time()
 		
 		mapped1, mapped2 = self.mappedTrees(doc1.getroot(), doc2.getroot())
+		distance = 1.0-Levenshtein.ratio(mapped1, mapped2)
 		
-		return 1.0-Levenshtein.ratio(mapped1, mapped2)
+		if timings is not None:
+			timings["parse"] = parsedTime - startTime
+			timings["distance"] = time.time() - parsedTime
+		return distance
 		
@@ -0,0 +1,157 @@
+import os
+import errno
+import fcntl
+import hashlib
+import cPickle
+import tempfile
+
+class CachedResponse(object):
+	"""HTTP response stored in ResponseCache together with its validators."""
+
+	def __init__(self, httpCode, data, headerStr, etag, lastModified):
+		"""
+		@param httpCode: HTTP code of the response as int
+		@param data: body as str
+		@param headerStr: HTTP headers as str
+		@param etag: value of ETag header or None
+		@param lastModified: value of Last-Modified header or None
+		"""
+		self.httpCode = httpCode
+		self.data = data
+		self.headerStr = headerStr
+		self.etag = etag
+		self.lastModified = lastModified
+
+	def conditionalHeaders(self):
+		"""Return list of request headers for revalidating the response."""
+		headers = []
+		if self.etag:
+			headers.append("If-None-Match: %s" % self.etag)
+		if self.lastModified:
+			headers.append("If-Modified-Since: %s" % self.lastModified)
+		return headers
+
+class ResponseCache(object):
+	"""On-disk cache of HTTP responses keyed by URL. Each response is a
+	pickled CachedResponse in its own file, written to a temporary file
+	first and renamed, so the cache can be shared by several processes.
+	Least recently used files are evicted once total size of the cache
+	exceeds the limit. Bytes stored since the last eviction are counted
+	in a file in the cache directory, so that eviction is triggered by
+	stores of all processes together (fetcher subprocesses are recycled
+	long before their own stores would trigger it).
+	"""
+
+	#fraction of the size limit stored since last eviction after which
+	#the cache is evicted again
+	evictFraction = 0.1
+
+	def __init__(self, cacheDir, maxBytes):
+		"""
+		@param cacheDir: directory for cached responses, created if missing
+		@param maxBytes: max total size of cached responses
+		"""
+		self.cacheDir = cacheDir
+		self.maxBytes = maxBytes
+		try:
+			os.makedirs(cacheDir)
+		except OSError, e:
+			if e.errno != errno.EEXIST:
+				raise
+
+	def _path(self, url):
+		return os.path.join(self.cacheDir, hashlib.sha1(url).hexdigest() + ".resp")
+
+	def lookup(self, url):
+		"""Return CachedResponse for URL or None if not cached."""
+		path = self._path(url)
+		try:
+			with open(path, "rb") as f:
+				cached = cPickle.load(f)
+			os.utime(path, None) #mark as recently used
+			return cached
+		except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+			return None
+
+	def store(self, url, httpCode, data, headers, headerStr):
+		"""Store response if it has ETag or Last-Modified validator.
+
+		@param url: IDNA-encoded URL of the response
+		@param httpCode: HTTP code of the response
+		@param data: body as str
+		@param headers: dict of response headers with lowercase names
+		@param headerStr: HTTP headers as str
+		"""
+		etag = headers.get("etag")
+		lastModified = headers.get("last-modified")
+		if not etag and not lastModified:
+			return
+
+		cached = CachedResponse(httpCode, data, headerStr, etag, lastModified)
+		(fd, tmpPath) = tempfile.mkstemp(dir=self.cacheDir, suffix=".tmp")
+		try:
+			with os.fdopen(fd, "wb") as f:
+				cPickle.dump(cached, f, cPickle.HIGHEST_PROTOCOL)
+				size = f.tell()
+			os.rename(tmpPath, self._path(url))
+		except:
+			os.unlink(tmpPath)
+			raise
+
+		if self._countStored(size):
+			self.evict()
+
+	def _countStored(self, size):
+		"""Add size of stored response to the counter shared by processes
+		using the cache directory.
+
+		@returns: True iff enough was stored since last eviction to evict
+		"""
+		fd = os.open(os.path.join(self.cacheDir, "stored.count"), os.O_RDWR | os.O_CREAT, 0644)
+		with os.fdopen(fd, "r+b") as f:
+			fcntl.flock(f, fcntl.LOCK_EX)
+			try:
+				stored = int(f.read() or 0)
+			except ValueError:
+				stored = 0 #torn write of a crashed process
+			stored += size
+			due = stored >= self.evictFraction * self.maxBytes
+			if due:
+				stored = 0
+			f.seek(0)
+			f.truncate()
+			f.write(str(stored))
+		return due
+
+	def evict(self):
+		"""Remove least recently used responses until the cache fits its
+		size limit. Only one process evicts at a time, others skip it.
+		"""
+		with open(os.path.join(self.cacheDir, "evict.lock"), "w") as lockFile:
+			try:
+				fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except IOError:
+				return #someone else is evicting
+
+			entries = []
+			totalSize = 0
+			for fname in os.listdir(self.cacheDir):
+				if not fname.endswith(".resp"):
+					continue
+				path = os.path.join(self.cacheDir, fname)
+				try:
+					st = os.stat(path)
+				except OSError:
+					continue
+				entries.append((st.st_mtime, st.st_size, path))
+				totalSize += st.st_size
+
+			entries.sort()
+			for (mtime, size, path) in entries:
+				if totalSize <= self.maxBytes:
+					break
+				try:
+					os.unlink(path)
+				except OSError:
+					pass
+				totalSize -= size
@@ -0,0 +1,140 @@
+import time
+import heapq
+import random
+import logging
+import threading
+
+import pycurl
+
+from http_client import HTTPFetcherError
+from latency import endpoint
+
+#error classes worth retrying, others (e.g. certificate validation) fail fast
+RETRYABLE = set(["timeout", "reset", "connect", "dns", "tls_handshake", "no_response"])
+
+#maps PyCURL error numbers to error classes
+_curlErrorClasses = {
+	pycurl.E_OPERATION_TIMEDOUT: "timeout",
+	pycurl.E_RECV_ERROR: "reset",
+	pycurl.E_SEND_ERROR: "reset",
+	pycurl.E_GOT_NOTHING: "reset",
+	pycurl.E_COULDNT_CONNECT: "connect",
+	pycurl.E_COULDNT_RESOLVE_HOST: "dns",
+	pycurl.E_SSL_CONNECT_ERROR: "tls_handshake",
+	pycurl.E_SSL_CACERT: "tls_verify",
+	pycurl.E_SSL_PEER_CERTIFICATE: "tls_verify",
+	pycurl.E_WRITE_ERROR: "other",
+}
+
+def classifyError(error):
+	"""Return class of error a comparison failed with.
+
+	@param error: exception raised while fetching/comparing pages
+	@returns: class name as str, e.g. "timeout" or "tls_verify"; see
+	RETRYABLE for classes that may succeed on retry
+	"""
+	if isinstance(error, pycurl.error):
+		errno = error.args and error.args[0]
+		return _curlErrorClasses.get(errno, "curl_%s" % errno)
+	if isinstance(error, HTTPFetcherError):
+		message = str(error)
+		if message.startswith("Pycurl fetch failed"):
+			return "no_response" #HTTP code 0
+		if message.startswith("Non-existent domain"):
+			return "nxdomain"
+		if message.startswith("Connecting to"):
+			return "connect_failed_earlier"
+		if message.startswith("Subprocess failed"):
+			return "subprocess_crash"
+		if message.startswith(("Too many redirects", "Redirect for", "Cycle detected")):
+			return "redirect"
+	return "other"
+
+class RetryQueue(threading.Thread):
+	"""Delays tasks that failed with retryable errors and puts them back
+	into the task scheduler after exponential backoff. Worker threads
+	don't block on the delay, the task is held here meanwhile (and still
+	counts as unfinished for scheduler's join()).
+	"""
+
+	def __init__(self, taskQueue, maxAttempts, baseDelay, maxDelay, latencyTracker=None):
+		"""
+		@param taskQueue: scheduler.HostScheduler the tasks come from
+		@param maxAttempts: max number of attempts of one task, including
+		the first one
+		@param baseDelay: delay in seconds before the first retry, doubled
+		for each further retry
+		@param maxDelay: max delay in seconds
+		@param latencyTracker: latency.LatencyTracker whose connect failures
+		of task's hosts are forgotten before retry, so that the retried
+		fetches don't fail fast
+		"""
+		self.taskQueue = taskQueue
+		self.maxAttempts = maxAttempts
+		self.baseDelay = baseDelay
+		self.maxDelay = maxDelay
+		self.latencyTracker = latencyTracker
+		self.cond = threading.Condition()
+		#heap of (due time, sequence number, task)
+		self.delayed = []
+		self.sequence = 0
+		self.retriedCount = 0
+		self.stopped = False
+		threading.Thread.__init__(self)
+		self.setDaemon(True)
+
+	def retry(self, task, errorClass):
+		"""Schedule retry of task if its error is retryable and it has
+		attempts left. Must be called instead of taskQueue.task_done(task)
+		by worker that got the task.
+
+		@param task: ComparisonTask that failed
+		@param errorClass: class of the error from classifyError()
+		@returns: True if the task will be retried, False if it failed
+		for good (and worker should call task_done as usual)
+		"""
+		if errorClass not in RETRYABLE or task.attempts >= self.maxAttempts or \
+				self.stopped:
+			return False
+
+		delay = min(self.maxDelay, self.baseDelay * 2 ** (task.attempts - 1))
+		delay *= random.uniform(0.75, 1.25) #don't retry whole batches at once
+		task.attempts += 1
+		self.taskQueue.defer(task)
+		with self.cond:
+			self.sequence += 1
+			heapq.heappush(self.delayed, (time.time() + delay, self.sequence, task))
+			self.retriedCount += 1
+			self.cond.notify()
+		return True
+
+	def clear(self):
+		"""Drop delayed tasks and don't accept new ones, e.g. when the run
+		is interrupted. Dropped tasks are marked finished in taskQueue.
+
+		@returns: list of dropped tasks
+		"""
+		with self.cond:
+			self.stopped = True
+			dropped = [task for (due, sequence, task) in self.delayed]
+			self.delayed = []
+		for task in dropped:
+			self.taskQueue.abandon(task)
+		return dropped
+
+	def run(self):
+		while True:
+			with self.cond:
+				while not self.delayed or self.delayed[0][0] > time.time():
+					if self.delayed:
+						self.cond.wait(self.delayed[0][0] - time.time())
+					else:
+						self.cond.wait()
+				(due, sequence, task) = heapq.heappop(self.delayed)
+
+			if self.latencyTracker:
+				for url in (task.plainUrl, task.transformedUrl):
+					self.latencyTracker.forgetFailure(endpoint(url))
+			logging.debug("Retrying %s -> %s, attempt %d", task.plainUrl,
+				task.transformedUrl, task.attempts)
+			self.taskQueue.requeue(task)
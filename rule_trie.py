@@ -1,5 +1,7 @@
 import urlparse
 
+from lru_cache import LRUCache
+
 ## Rule trie
 #
 # Rule trie is a suffix tree that resolves which rulesets should apply for a
@@ -40,6 +42,12 @@ import urlparse
 # of N parts is O(N) if there are no * in the tree. Otherwise in theory
 # it could be O(2^N), but the HTTPS Everywhere rules require only one *, so we
 # still get O(N).
+#
+# Once all rulesets are added, the trie can be "frozen" - a compact read-only
+# copy made of FrozenDomainNode objects is built and used for lookups. The
+# looked up FQDN is IDNA-encoded and split only once and the tree is walked
+# iteratively, keeping a list of nodes matched so far (more than one only
+# if some * nodes matched too).
 
 class RuleTransformError(ValueError):
 	"""Thrown when invalid scheme like file:/// is attempted to be
@@ -115,6 +123,79 @@ class DomainNode(object):
 		return "<DomainNode for '%s>" % (self.subDomain,)
 
 
+class FrozenDomainNode(object):
+	"""Node of frozen (read-only) suffix trie. Children are keyed by part
+	of FQDN between dots, applicable rulesets are stored as tuple.
+	"""
+	
+	__slots__ = ("children", "rulesets")
+	
+	def __init__(self, children, rulesets):
+		"""
+		@param children: dict of FrozenDomainNode children or None
+		if there are no children
+		@param rulesets: tuple of rules.Ruleset for this node
+		"""
+		self.children = children
+		self.rulesets = rulesets
+	
+	@classmethod
+	def fromDomainNode(cls, node):
+		"""Build frozen copy of DomainNode subtree."""
+		children = None
+		if node.children:
+			children = dict((subDomain, cls.fromDomainNode(child))
+				for (subDomain, child) in node.children.iteritems())
+		
+		rulesets = []
+		for ruleset in node.rulesets:
+			if ruleset not in rulesets:
+				rulesets.append(ruleset)
+		
+		return cls(children, tuple(rulesets))
+	
+	def matchingRulesets(self, domain):
+		"""Find matching rulesets for domain in this subtree.
+		@param domain: domain to search for, must not contain wildcards
+		@return: tuple of applicable rulesets
+		"""
+		#make sure domain is in ASCII - either "plain old domain" or
+		#punycode-encoded IDN domain
+		if not isinstance(domain, unicode):
+			domain = domain.decode("utf-8")
+		labels = domain.encode("idna").split(".")
+		
+		nodes = (self,)
+		for label in reversed(labels):
+			matched = []
+			for node in nodes:
+				children = node.children
+				if not children:
+					continue
+				#consider direct matches as well as wildcard matches
+				#so that match for things like "bla.google.*" work
+				child = children.get(label)
+				if child:
+					matched.append(child)
+				wildcardChild = children.get("*")
+				if wildcardChild:
+					matched.append(wildcardChild)
+			
+			if not matched:
+				return ()
+			nodes = matched
+		
+		if len(nodes) == 1:
+			return nodes[0].rulesets
+		
+		applicableRules = []
+		for node in nodes:
+			for ruleset in node.rulesets:
+				if ruleset not in applicableRules:
+					applicableRules.append(ruleset)
+		return tuple(applicableRules)
+	
+
 class RuleMatch(object):
 	"""Result of a rule match, contains transformed url and ruleset that
 	matched (might be None if no match was found).
@@ -130,20 +211,78 @@ class RuleMatch(object):
 		self.ruleset = ruleset
 	
 class RuleTrie(object):
-	"""Suffix trie for rulesets."""
+	"""Suffix trie for rulesets.
 	
-	def __init__(self):
+	Results of lookups can be memoized in LRU caches - matching rulesets
+	per FQDN and RuleMatch per whole URL. Caches are cleared whenever the
+	trie changes.
+	"""
+	
+	def __init__(self, fqdnCacheSize=4096, urlCacheSize=0):
+		"""
+		@param fqdnCacheSize: max number of FQDNs whose matching
+		rulesets are cached, 0 turns the cache off
+		@param urlCacheSize: max number of URLs whose RuleMatch is
+		cached, 0 turns the cache off
+		"""
 		self.root = DomainNode("", [])
+		self.frozenRoot = None
+		self.fqdnCache = None
+		self.urlCache = None
+		if fqdnCacheSize > 0:
+			self.fqdnCache = LRUCache(fqdnCacheSize)
+		if urlCacheSize > 0:
+			self.urlCache = LRUCache(urlCacheSize)
 	
 	def matchingRulesets(self, fqdn):
 		"""Return rulesets applicable for FQDN. Wildcards not allowed.
 		"""
-		return self.root.matchingRulesets(fqdn)
+		fqdnCache = self.fqdnCache
+		if fqdnCache is not None:
+			generation = fqdnCache.generation
+			rulesets = fqdnCache.get(fqdn)
+			if rulesets is not None:
+				return rulesets
+		
+		frozenRoot = self.frozenRoot
+		if frozenRoot is not None:
+			rulesets = frozenRoot.matchingRulesets(fqdn)
+		else:
+			rulesets = tuple(self.root.matchingRulesets(fqdn))
+		
+		if fqdnCache is not None:
+			fqdnCache.put(fqdn, rulesets, generation)
+		return rulesets
+	
+	def clearCaches(self):
+		"""Drop memoized lookup results."""
+		for cache in (self.fqdnCache, self.urlCache):
+			if cache is not None:
+				cache.clear()
+	
+	def cacheStats(self):
+		"""Return string with hit/miss counters of the caches for logging."""
+		stats = []
+		if self.fqdnCache is not None:
+			stats.append("FQDN cache: %s" % self.fqdnCache.stats())
+		if self.urlCache is not None:
+			stats.append("URL cache: %s" % self.urlCache.stats())
+		return "; ".join(stats) or "caches disabled"
+	
+	def freeze(self):
+		"""Build compact read-only copy of the trie that is used for
+		lookups from now on. Should be called once all rulesets are
+		added; addRuleset() called later drops the frozen copy.
+		"""
+		self.frozenRoot = FrozenDomainNode.fromDomainNode(self.root)
+		self.clearCaches()
 	
 	def addRuleset(self, ruleset):
 		"""Creates structure for given ruleset in the trie.
 		@param ruleset: rules.Ruleset instance
 		"""
+		self.frozenRoot = None
+		
 		for target in ruleset.targets:
 			node = self.root
 			#enumerate parts so we know when we hit leaf where
@@ -163,6 +302,10 @@ class RuleTrie(object):
 					partNode.rulesets.append(ruleset)
 				
 				node = partNode
+		
+		#clear after the change, so that lookups done during it are
+		#not cached (see LRUCache generations)
+		self.clearCaches()
 	
 	def acceptedScheme(self, url):
 		"""Returns True iff the scheme in URL is accepted (http, https).
@@ -178,6 +321,13 @@ class RuleTrie(object):
 		@returns: RuleMatch with tranformed URL and ruleset that applied
 		@throws: RuleTransformError if scheme is wrong (e.g. file:///)
 		"""
+		urlCache = self.urlCache
+		if urlCache is not None:
+			generation = urlCache.generation
+			ruleMatch = urlCache.get(url)
+			if ruleMatch is not None:
+				return ruleMatch
+		
 		parsed = urlparse.urlparse(url)
 		if parsed.scheme not in ("http", "https"):
 			raise RuleTransformError("Unknown scheme '%s' in '%s'" % \
@@ -186,11 +336,16 @@ class RuleTrie(object):
 		fqdn = parsed.netloc.lower()
 		matching = self.matchingRulesets(fqdn)
 		
+		ruleMatch = RuleMatch(url, None)
 		for ruleset in matching:
 			newUrl = ruleset.apply(url)
 			if newUrl != url:
-				return RuleMatch(newUrl, ruleset)
-		return RuleMatch(url, None)
+				ruleMatch = RuleMatch(newUrl, ruleset)
+				break
+		
+		if urlCache is not None:
+			urlCache.put(url, ruleMatch, generation)
+		return ruleMatch
 	
 	def prettyPrint(self):
 		self.root.prettyPrint()
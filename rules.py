@@ -1,19 +1,79 @@
 import regex
 
+from lru_cache import LRUCache
+
+#Compiled patterns shared among all rules and exclusions, so that identical
+#patterns from different rulesets are compiled only once.
+_patternCache = LRUCache(10000)
+
+def compilePattern(pattern):
+	"""Return compiled regex for pattern, using the shared pattern cache."""
+	compiled = _patternCache.get(pattern)
+	if compiled is None:
+		compiled = regex.compile(pattern)
+		_patternCache.put(pattern, compiled)
+	return compiled
+
+def topLevelAlternatives(pattern):
+	"""Split regex pattern on "|" that is not inside a group or character
+	set, e.g. "^a(b|c)|d" into ["^a(b|c)", "d"].
+	"""
+	alternatives = []
+	depth = 0
+	start = 0
+	idx = 0
+	while idx < len(pattern):
+		char = pattern[idx]
+		if char == "\\":
+			idx += 1 #skip escaped char
+		elif char == "[":
+			#"]" right after "[" or "[^" is literal
+			idx += 1
+			if pattern[idx:idx+1] == "^":
+				idx += 1
+			if pattern[idx:idx+1] == "]":
+				idx += 1
+			while idx < len(pattern) and pattern[idx] != "]":
+				if pattern[idx] == "\\":
+					idx += 1
+				idx += 1
+		elif char == "(":
+			depth += 1
+		elif char == ")":
+			depth -= 1
+		elif char == "|" and depth == 0:
+			alternatives.append(pattern[start:idx])
+			start = idx + 1
+		idx += 1
+	alternatives.append(pattern[start:])
+	return alternatives
+
 class Rule(object):
-	"""Represents one from->to rule element."""
+	"""Represents one from->to rule element. The "from" regex is compiled
+	on first use.
+	"""
 	
-	def __init__(self, ruleElem):
-		"""Convert one <rule> element.
-		@param: etree <rule>Element
+	#JS capture reference like $1
+	_jsCaptureRe = regex.compile(r"\$(\d)")
+	
+	def __init__(self, fromPattern, toPattern):
+		"""Create rule from attributes of one <rule> element.
+		@param fromPattern: "from" attribute - regex to match
+		@param toPattern: "to" attribute - replacement with JS $N captures
 		"""
-		attrs = ruleElem.attrib
-		self.fromPattern = attrs["from"]
+		self.fromPattern = fromPattern
 		#Switch $1, $2... JS capture patterns to Python \g<1>, \g<2>...
 		#The \g<1> named capture is used instead of \1 because it would
 		#break for rules whose domain begins with a digit.
-		self.toPattern = regex.sub(r"\$(\d)", r"\\g<\1>", attrs["to"])
-		self.fromRe = regex.compile(self.fromPattern)
+		self.toPattern = self._jsCaptureRe.sub(r"\\g<\1>", toPattern)
+		self._fromRe = None
+	
+	@property
+	def fromRe(self):
+		"""Compiled "from" regex"""
+		if self._fromRe is None:
+			self._fromRe = compilePattern(self.fromPattern)
+		return self._fromRe
 	
 	def apply(self, url):
 		"""Apply rule to URL string and return result."""
@@ -36,14 +96,23 @@ class Rule(object):
 		return hash(self._id())
 
 class Exclusion(object):
-	"""Exclusion rule for <exclusion pattern=""> element"""
+	"""Exclusion rule for <exclusion pattern=""> element. The pattern is
+	compiled on first use.
+	"""
 	
-	def __init__(self, exclusionElem):
-		"""Create instance from <exclusion> element
-		@param exclusionElem: <exclusion> element from lxml tree
+	def __init__(self, exclusionPattern):
+		"""Create instance from <exclusion> element's pattern
+		@param exclusionPattern: "pattern" attribute of <exclusion> element
 		"""
-		self.exclusionPattern = exclusionElem.attrib["pattern"]
-		self.exclusionRe = regex.compile(self.exclusionPattern)
+		self.exclusionPattern = exclusionPattern
+		self._exclusionRe = None
+	
+	@property
+	def exclusionRe(self):
+		"""Compiled exclusion regex"""
+		if self._exclusionRe is None:
+			self._exclusionRe = compilePattern(self.exclusionPattern)
+		return self._exclusionRe
 	
 	def matches(self, url):
 		"""Returns true iff this exclusion rule matches given url
@@ -60,32 +129,44 @@ class Ruleset(object):
 	#extract attribute value and decode to ASCII with IDN punycode encoding
 	_idnAttrs = lambda attrList: tuple(unicode(attr).encode("idna") for attr in attrList)
 	
-	#convert each etree Element of list into Rule
-	_rulesConvert = lambda elemList: [Rule(elem) for elem in elemList]
+	#extract (from, to) attributes of each <rule> Element of list
+	_rulesAttrs = lambda elemList: [(elem.attrib["from"], elem.attrib["to"]) for elem in elemList]
 	
-	#convert each etree Element of list into Exclusion
-	_exclusionConvert = lambda elemList: [Exclusion(elem) for elem in elemList]
+	#extract pattern attribute of each <exclusion> Element of list
+	_exclusionAttrs = lambda elemList: [elem.attrib["pattern"] for elem in elemList]
+	
+	#marks combined regexes that were not compiled yet
+	_notCompiled = object()
+	
+	#Patterns that can't be merged into a single alternation with other
+	#patterns - backreferences and named groups would be renumbered or
+	#clash, global inline flags would apply to whole alternation.
+	_unmergeableRe = regex.compile(r"\\[1-9]|\\g<|\(\?P?<[A-Za-z_]|\(\?P=|\(\?[a-zA-Z]+\)")
 	
 	#functional description of converting XML elements/attributes into
-	#instance variables. Tuples are:
+	#plain (picklable) values of instance variables. Tuples are:
 	#(attribute name in this class, XPath expression, conversion function into value)
 	_attrConvert = [
 		("name",	"@name", 		_strAttr),
 		("platform",	"@platform", 		_strAttr),
 		("defaultOff",	"@default_off", 	_strAttr),
 		("targets",	"target/@host",		_idnAttrs),
-		("rules",	"rule", 		_rulesConvert),
-		("exclusions",	"exclusion", 		_exclusionConvert),
+		("rules",	"rule", 		_rulesAttrs),
+		("exclusions",	"exclusion", 		_exclusionAttrs),
 	]
 	
-	def __init__(self, xmlTree, filename):
+	def __init__(self, xmlTree, filename, parsed=None):
 		"""Create instance from given XML (sub)tree.
 		
 		@param xmlTree: XML (sub)tree corresponding to the <ruleset> element
 		@param filename: filename this ruleset originated from (for
 		reporting purposes)
+		@param parsed: result of parseXml() for the ruleset, used instead
+		of xmlTree if given (xmlTree may be None then)
 		"""
-		root = xmlTree
+		if parsed is None:
+			parsed = self.parseXml(xmlTree)
+		
 		#set default values for rule attributes, makes it easier for
 		#code completion
 		self.name = None
@@ -95,16 +176,98 @@ class Ruleset(object):
 		self.targets = []
 		self.exclusions = []
 		self.filename = filename
+		#SHA1 digest of the ruleset file, set by loader
+		self.digest = None
+		#combined regexes of all exclusions/rules (see _combinePatterns),
+		#compiled on first use
+		self._exclusionsRe = self._notCompiled
+		self._rulesRe = self._notCompiled
+		
+		for (attrName, value) in parsed.iteritems():
+			setattr(self, attrName, value)
+		
+		self.rules = [Rule(fromPattern, toPattern) for (fromPattern, toPattern) in self.rules]
+		self.exclusions = [Exclusion(pattern) for pattern in self.exclusions]
+	
+	@property
+	def exclusionsRe(self):
+		"""Combined regex of all exclusions or None if not applicable"""
+		if self._exclusionsRe is self._notCompiled:
+			self._exclusionsRe = self._combinePatterns(
+				[exclusion.exclusionPattern for exclusion in self.exclusions], False)
+		return self._exclusionsRe
+	
+	@property
+	def rulesRe(self):
+		"""Combined regex of all rules or None if not applicable"""
+		if self._rulesRe is self._notCompiled:
+			self._rulesRe = self._combinePatterns(
+				[rule.fromPattern for rule in self.rules], True)
+		return self._rulesRe
+	
+	def precompile(self):
+		"""Compile all regexes now instead of on first use."""
+		for rule in self.rules:
+			rule.fromRe
+		for exclusion in self.exclusions:
+			exclusion.exclusionRe
+		self.exclusionsRe
+		self.rulesRe
+	
+	@classmethod
+	def parseXml(cls, xmlTree):
+		"""Extract ruleset attributes from XML tree into plain values that
+		can be pickled, e.g. to be cached or passed between processes.
 		
-		for (attrName, xpath, conversion) in self._attrConvert:
-			elems = root.xpath(xpath)
+		@param xmlTree: XML (sub)tree corresponding to the <ruleset> element
+		@returns: dict mapping instance variable names to values; rules
+		are (from, to) tuples and exclusions are pattern strings
+		"""
+		parsed = {}
+		for (attrName, xpath, conversion) in cls._attrConvert:
+			elems = xmlTree.xpath(xpath)
 			if elems:
-				setattr(self, attrName, conversion(elems))
-			
+				parsed[attrName] = conversion(elems)
+		return parsed
+	
+	@classmethod
+	def _combinePatterns(cls, patterns, namedAlternatives):
+		"""Compile patterns into single regex alternation, so that
+		one scan of URL finds the first matching pattern.
 		
+		@param patterns: list of regex patterns
+		@param namedAlternatives: if True, each alternative is a named
+		group "r<index>" so that the matching pattern can be told from
+		match's lastgroup. Patterns then must be anchored by ^ (in each of
+		their top-level alternatives), otherwise leftmost match would not
+		be the first pattern in order.
+		@returns: compiled regex or None if there are less than two
+		patterns or they can't be combined
+		"""
+		if len(patterns) < 2:
+			return None
+		
+		for pattern in patterns:
+			if cls._unmergeableRe.search(pattern):
+				return None
+			if namedAlternatives and not all(alternative.startswith("^")
+					for alternative in topLevelAlternatives(pattern)):
+				return None
+		
+		if namedAlternatives:
+			alternatives = ["(?P<r%d>%s)" % (idx, pattern) for (idx, pattern) in enumerate(patterns)]
+		else:
+			alternatives = ["(?:%s)" % pattern for pattern in patterns]
+		
+		try:
+			return regex.compile("|".join(alternatives))
+		except regex.error:
+			return None
 	
 	def excludes(self, url):
 		"""Returns True iff one of exclusion patterns matches the url."""
+		if self.exclusionsRe is not None:
+			return self.exclusionsRe.match(url) is not None
 		return any((exclusion.matches(url) for exclusion in self.exclusions))
 	
 	def apply(self, url):
@@ -116,7 +279,16 @@ class Ruleset(object):
 		if self.excludes(url):
 			return url
 		
-		for rule in self.rules:
+		rules = self.rules
+		if self.rulesRe is not None:
+			#rules before the first matching one can't rewrite the URL,
+			#the ones after are tried only if it doesn't change the URL
+			match = self.rulesRe.match(url)
+			if match is None:
+				return url
+			rules = rules[int(match.lastgroup[1:]):]
+		
+		for rule in rules:
 			newUrl = rule.apply(url)
 			if url != newUrl:
 				return newUrl #only one rewrite
@@ -0,0 +1,191 @@
+import os
+import logging
+import hashlib
+import cPickle
+import multiprocessing
+import cStringIO
+
+from lxml import etree
+
+from rules import Ruleset
+
+## Ruleset loading
+#
+# Parsing XML of rulesets (plus XPath queries in Ruleset.parseXml) is done
+# in a pool of processes. Parsed plain data of each file are stored in a
+# cache file, keyed by file path and validated by mtime, size and SHA1 of
+# file contents. Unchanged files are then loaded from cache without any XML
+# parsing on the next run.
+#
+# Files are first pre-scanned for attributes of the root <ruleset> element,
+# default_off rulesets are not parsed any further (and only their name and
+# default_off reason are cached).
+
+def fileDigest(fname):
+	"""Return hex SHA1 digest of file contents."""
+	with open(fname, "rb") as f:
+		return hashlib.sha1(f.read()).hexdigest()
+
+def rootAttributes(xmlData):
+	"""Return attributes of root element of XML document without parsing
+	the rest of it.
+	
+	@param xmlData: XML document as str
+	@returns: dict of attributes
+	"""
+	for (event, elem) in etree.iterparse(cStringIO.StringIO(xmlData), events=("start",)):
+		return dict(elem.attrib)
+	return {}
+
+def parseRulesetFile(fname):
+	"""Parse ruleset XML file into plain data. Intended to be run in
+	loader pool processes.
+
+	@param fname: path to ruleset XML file
+	@returns: tuple (fname, digest, parsed data from Ruleset.parseXml);
+	parsed data of default_off ruleset contain only name and defaultOff
+	"""
+	with open(fname, "rb") as f:
+		xmlData = f.read()
+	digest = hashlib.sha1(xmlData).hexdigest()
+	
+	attrs = rootAttributes(xmlData)
+	if attrs.get("default_off"):
+		parsed = {
+			"name": attrs.get("name") and unicode(attrs["name"]),
+			"defaultOff": unicode(attrs["default_off"]),
+		}
+	else:
+		parsed = Ruleset.parseXml(etree.fromstring(xmlData))
+	
+	return (fname, digest, parsed)
+
+class RulesetCache(object):
+	"""On-disk cache of parsed ruleset files."""
+
+	#version of layout of cached data (output of Ruleset.parseXml and
+	#parseRulesetFile), increment on change so that old caches are discarded
+	formatVersion = 2
+
+	def __init__(self, cacheFname):
+		"""Load cache from file if it exists.
+
+		@param cacheFname: path to cache file, None for cache kept
+		only in memory
+		"""
+		self.cacheFname = cacheFname
+		#maps ruleset fname to tuple (mtime, size, digest, parsed)
+		self.entries = {}
+		self.dirty = False
+
+		if cacheFname and os.path.exists(cacheFname):
+			try:
+				with open(cacheFname, "rb") as f:
+					data = cPickle.load(f)
+				if data.get("version") == self.formatVersion:
+					self.entries = data["entries"]
+				else:
+					logging.info("Ignoring ruleset cache %s of other format version", cacheFname)
+			except Exception, e:
+				logging.warn("Ignoring unreadable ruleset cache %s: %s", cacheFname, e)
+				self.entries = {}
+
+	def lookup(self, fname):
+		"""Return parsed data of ruleset file if cached and unchanged.
+
+		@returns: tuple (digest, parsed) or None if not cached
+		"""
+		entry = self.entries.get(fname)
+		if not entry:
+			return None
+
+		(mtime, size, digest, parsed) = entry
+		st = os.stat(fname)
+		if (mtime, size) == (st.st_mtime, st.st_size):
+			return (digest, parsed)
+
+		#file was touched, but contents may still be same (e.g. checkout)
+		if size == st.st_size and fileDigest(fname) == digest:
+			self.store(fname, digest, parsed)
+			return (digest, parsed)
+
+		return None
+
+	def store(self, fname, digest, parsed):
+		"""Record parsed data of ruleset file."""
+		st = os.stat(fname)
+		self.entries[fname] = (st.st_mtime, st.st_size, digest, parsed)
+		self.dirty = True
+
+	def save(self, keepFnames):
+		"""Write cache to disk if it changed.
+
+		@param keepFnames: ruleset files whose entries are kept, entries
+		of other (e.g. deleted) files are dropped
+		"""
+		keepFnames = set(keepFnames)
+		for fname in self.entries.keys():
+			if fname not in keepFnames:
+				del self.entries[fname]
+				self.dirty = True
+
+		if not self.cacheFname or not self.dirty:
+			return
+
+		tmpFname = self.cacheFname + ".tmp"
+		with open(tmpFname, "wb") as f:
+			cPickle.dump({"version": self.formatVersion, "entries": self.entries}, f,
+				cPickle.HIGHEST_PROTOCOL)
+		os.rename(tmpFname, self.cacheFname)
+		self.dirty = False
+
+def loadRulesets(xmlFnames, cacheFname=None, processes=None):
+	"""Load rulesets from XML files, using cache for unchanged ones and
+	parsing the rest in a pool of processes. The cache file is updated
+	once all rulesets are loaded.
+
+	@param xmlFnames: list of ruleset XML files
+	@param cacheFname: path to cache file or None to not use one
+	@param processes: number of parsing processes, None for number of
+	CPUs; 1 parses in this process
+	@returns: generator of rules.Ruleset instances in order of xmlFnames,
+	including default_off ones
+	"""
+	cache = RulesetCache(cacheFname)
+
+	cached = {}
+	uncached = []
+	for xmlFname in xmlFnames:
+		entry = cache.lookup(xmlFname)
+		if entry is None:
+			uncached.append(xmlFname)
+		else:
+			cached[xmlFname] = entry
+	logging.debug("Rulesets cached: %d, to be parsed: %d",
+		len(xmlFnames) - len(uncached), len(uncached))
+
+	pool = None
+	if len(uncached) > 1 and processes != 1:
+		pool = multiprocessing.Pool(processes)
+		parsedIter = pool.imap(parseRulesetFile, uncached, chunksize=16)
+	else:
+		parsedIter = (parseRulesetFile(xmlFname) for xmlFname in uncached)
+
+	try:
+		for xmlFname in xmlFnames:
+			entry = cached.get(xmlFname)
+			if entry is None:
+				(parsedFname, digest, parsed) = parsedIter.next()
+				cache.store(parsedFname, digest, parsed)
+			else:
+				(digest, parsed) = entry
+
+			ruleset = Ruleset(None, xmlFname, parsed)
+			ruleset.digest = digest
+			yield ruleset
+	finally:
+		if pool:
+			pool.terminate()
+			pool.join()
+
+	cache.save(xmlFnames)
@@ -0,0 +1,189 @@
+import threading
+import collections
+import time
+import Queue
+
+#second-level labels commonly used under country TLDs (as in co.uk)
+_countrySecondLevels = set(["ac", "co", "com", "edu", "gov", "go", "ne", "net",
+	"or", "org"])
+
+def registeredDomain(fqdn):
+	"""Approximate registered domain of FQDN - last two labels, or last
+	three if the second-level label is a common part of country public
+	suffixes (e.g. co.uk, com.au). No public suffix list is used.
+
+	@param fqdn: FQDN as str
+	@returns: registered domain as str
+	"""
+	labels = fqdn.lower().rstrip(".").split(".")
+	if all(label.isdigit() for label in labels):
+		return fqdn #IPv4 address
+	if len(labels) > 2 and len(labels[-1]) == 2 and labels[-2] in _countrySecondLevels:
+		return ".".join(labels[-3:])
+	return ".".join(labels[-2:])
+
+class HostScheduler(object):
+	"""Task queue that groups tasks by host (e.g. by IP address or
+	registered domain) and hands them out in round-robin order among the
+	groups, with at most maxPerGroup tasks of one group in flight. The
+	interface follows Queue.Queue, except that task_done() takes the
+	finished task.
+	"""
+
+	def __init__(self, maxPerGroup, groupKey, maxsize=0):
+		"""
+		@param maxPerGroup: max number of tasks of one group handed out by
+		get() and not yet marked by task_done()
+		@param groupKey: function returning group key of a task
+		@param maxsize: max number of waiting tasks after which put()
+		blocks, 0 means no limit
+		"""
+		self.maxPerGroup = maxPerGroup
+		self.groupKey = groupKey
+		self.maxsize = maxsize
+		self.cond = threading.Condition()
+		#maps group key to deque of waiting tasks
+		self.groups = {}
+		#round-robin order of groups with waiting tasks that may run more
+		self.ready = collections.deque()
+		self.readySet = set()
+		#maps group key to number of tasks in flight
+		self.inFlight = collections.defaultdict(int)
+		#maps tasks in flight to their group keys
+		self.taskKeys = {}
+		self.waitingCount = 0
+		self.unfinishedCount = 0
+
+	def _makeReady(self, key):
+		if key in self.groups and key not in self.readySet and \
+				self.inFlight.get(key, 0) < self.maxPerGroup:
+			self.ready.append(key)
+			self.readySet.add(key)
+
+	def _release(self, task):
+		key = self.taskKeys.pop(task)
+		self.inFlight[key] -= 1
+		if self.inFlight[key] == 0:
+			del self.inFlight[key]
+		self._makeReady(key)
+
+	def put(self, task):
+		"""Add task to its group, blocks while the scheduler is full."""
+		key = self.groupKey(task)
+		with self.cond:
+			while self.maxsize > 0 and self.waitingCount >= self.maxsize:
+				self.cond.wait()
+			self.groups.setdefault(key, collections.deque()).append(task)
+			self.waitingCount += 1
+			self.unfinishedCount += 1
+			self._makeReady(key)
+			self.cond.notify_all()
+
+	def get(self, block=True, timeout=None):
+		"""Remove and return task of the next group in round-robin order
+		that has less than maxPerGroup tasks in flight.
+
+		@param block: wait for a task if none can be handed out now
+		@param timeout: max seconds to wait, None for no limit
+		@throws Queue.Empty: if no task could be handed out
+		"""
+		with self.cond:
+			if timeout is not None:
+				deadline = time.time() + timeout
+			while not self.ready:
+				if not block:
+					raise Queue.Empty
+				if timeout is None:
+					self.cond.wait()
+				else:
+					remaining = deadline - time.time()
+					if remaining <= 0:
+						raise Queue.Empty
+					self.cond.wait(remaining)
+
+			key = self.ready.popleft()
+			self.readySet.discard(key)
+			tasks = self.groups[key]
+			task = tasks.popleft()
+			if not tasks:
+				del self.groups[key]
+			self.inFlight[key] += 1
+			self.taskKeys[task] = key
+			self.waitingCount -= 1
+			self._makeReady(key) #goes to the end of round-robin order
+			self.cond.notify_all()
+			return task
+
+	def task_done(self, task):
+		"""Mark task returned by get() as finished, so that another task
+		of its group may be handed out.
+		"""
+		with self.cond:
+			self._release(task)
+			self.unfinishedCount -= 1
+			self.cond.notify_all()
+
+	def defer(self, task):
+		"""Release group slot of task returned by get() without marking
+		it finished - the task is to be put back later by requeue().
+		"""
+		with self.cond:
+			self._release(task)
+			self.cond.notify_all()
+
+	def requeue(self, task):
+		"""Put back task released by defer(), e.g. to retry it."""
+		key = self.groupKey(task)
+		with self.cond:
+			self.groups.setdefault(key, collections.deque()).append(task)
+			self.waitingCount += 1
+			self._makeReady(key)
+			self.cond.notify_all()
+
+	def abandon(self, task):
+		"""Mark task released by defer() as finished without running it."""
+		with self.cond:
+			self.unfinishedCount -= 1
+			self.cond.notify_all()
+
+	def clear(self):
+		"""Remove all waiting tasks, e.g. when the run is interrupted.
+		Tasks in flight are not affected.
+
+		@returns: list of removed tasks
+		"""
+		with self.cond:
+			removed = []
+			for tasks in self.groups.itervalues():
+				removed.extend(tasks)
+			self.groups.clear()
+			self.ready.clear()
+			self.readySet.clear()
+			self.waitingCount = 0
+			self.unfinishedCount -= len(removed)
+			self.cond.notify_all()
+			return removed
+
+	def join(self, timeout=None):
+		"""Block until all tasks that were put are marked as done.
+
+		@param timeout: max seconds to wait, None for no limit
+		@returns: True if all tasks are done, False on timeout
+		"""
+		with self.cond:
+			if timeout is not None:
+				deadline = time.time() + timeout
+			while self.unfinishedCount:
+				if timeout is None:
+					self.cond.wait()
+				else:
+					remaining = deadline - time.time()
+					if remaining <= 0:
+						return False
+					self.cond.wait(remaining)
+			return True
+
+	def qsize(self):
+		"""Return number of waiting tasks."""
+		with self.cond:
+			return self.waitingCount
@@ -0,0 +1,134 @@
+import time
+import sqlite3
+import threading
+
+class StateStore(object):
+	"""Persistent store of comparison results in SQLite database. For
+	each plain/transformed URL pair it keeps the last result along with
+	SHA1 digest of the ruleset file that rewrote the URL, so that pairs
+	whose ruleset didn't change can be skipped on the next run.
+	"""
+
+	#number of recorded results after which they are committed
+	commitInterval = 50
+
+	def __init__(self, dbFname):
+		"""Open (and create if needed) the database.
+
+		@param dbFname: path to SQLite database file
+		"""
+		self.conn = sqlite3.connect(dbFname, check_same_thread=False)
+		#reentrant, sync() may be called from signal handler
+		self.lock = threading.RLock()
+		self.uncommitted = 0
+
+		self.conn.execute("""CREATE TABLE IF NOT EXISTS results (
+			plain_url TEXT NOT NULL,
+			transformed_url TEXT NOT NULL,
+			rule_fname TEXT,
+			ruleset_digest TEXT,
+			status TEXT,
+			distance REAL,
+			plain_code INTEGER,
+			transformed_code INTEGER,
+			error TEXT,
+			checked REAL,
+			error_class TEXT,
+			attempts INTEGER,
+			PRIMARY KEY (plain_url, transformed_url))""")
+		
+		#databases created by older versions lack the later columns
+		columns = set(row[1] for row in self.conn.execute("PRAGMA table_info(results)"))
+		for (column, columnType) in (("error_class", "TEXT"), ("attempts", "INTEGER")):
+			if column not in columns:
+				self.conn.execute("ALTER TABLE results ADD COLUMN %s %s" % (column, columnType))
+		self.conn.commit()
+
+	def record(self, result):
+		"""Store result of comparison, replacing the previous one.
+
+		@param result: check_rules.ComparisonResult instance
+		"""
+		task = result.task
+		with self.lock:
+			self.conn.execute("INSERT OR REPLACE INTO results (plain_url, transformed_url, " \
+				"rule_fname, ruleset_digest, status, distance, plain_code, transformed_code, " \
+				"error, checked, error_class, attempts) " \
+				"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+				(task.plainUrl, task.transformedUrl, task.ruleFname,
+				task.rulesetDigest, result.status, result.distance,
+				result.plainRcode, result.transformedRcode,
+				result.errorStr, time.time(), result.errorClass,
+				result.attempts))
+			self.uncommitted += 1
+			if self.uncommitted >= self.commitInterval:
+				self.conn.commit()
+				self.uncommitted = 0
+
+	def sync(self):
+		"""Commit recorded results."""
+		with self.lock:
+			self.conn.commit()
+			self.uncommitted = 0
+
+	def isFresh(self, plainUrl, transformedUrl, rulesetDigest, maxAge):
+		"""Returns True iff the URL pair was checked less than maxAge
+		seconds ago with the same version of ruleset file. Results with
+		error status are never fresh, errors are mostly transient.
+		"""
+		with self.lock:
+			row = self.conn.execute("SELECT ruleset_digest, checked, status FROM results " \
+				"WHERE plain_url = ? AND transformed_url = ?",
+				(plainUrl, transformedUrl)).fetchone()
+
+		if row is None or rulesetDigest is None:
+			return False
+		(digest, checked, status) = row
+		return digest == rulesetDigest and checked >= time.time() - maxAge and \
+			status != "error"
+
+	def merge(self, otherFname):
+		"""Copy results from another state database (e.g. of a shard)
+		unless this one has a more recent result for the same URL pair.
+
+		@param otherFname: path to SQLite database written by StateStore
+		@returns: number of copied results
+		"""
+		other = sqlite3.connect(otherFname)
+		try:
+			cursor = other.execute("SELECT * FROM results")
+			columns = [d[0] for d in cursor.description]
+			rows = cursor.fetchall()
+		finally:
+			other.close()
+
+		checkedIndex = columns.index("checked")
+		merged = 0
+		with self.lock:
+			for row in rows:
+				plainUrl = row[columns.index("plain_url")]
+				transformedUrl = row[columns.index("transformed_url")]
+				existing = self.conn.execute("SELECT checked FROM results " \
+					"WHERE plain_url = ? AND transformed_url = ?",
+					(plainUrl, transformedUrl)).fetchone()
+				if existing and existing[0] >= row[checkedIndex]:
+					continue
+				self.conn.execute("INSERT OR REPLACE INTO results (%s) VALUES (%s)" % \
+					(", ".join(columns), ", ".join("?" * len(columns))), row)
+				merged += 1
+			self.conn.commit()
+		return merged
+
+	def results(self):
+		"""Return list of all results as dicts keyed by column names."""
+		with self.lock:
+			cursor = self.conn.execute("SELECT * FROM results " \
+				"ORDER BY rule_fname, plain_url, transformed_url")
+			columns = [d[0] for d in cursor.description]
+			return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+	def close(self):
+		"""Commit outstanding results and close the database."""
+		with self.lock:
+			self.conn.commit()
+			self.conn.close()
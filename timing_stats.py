@@ -0,0 +1,129 @@
+import bisect
+import threading
+
+#phases of a fetch derived from PyCURL times, which are measured from the
+#start of the transfer (e.g. connect includes namelookup)
+FETCH_PHASES = ("dns", "tcp_connect", "tls_handshake", "server_wait", "transfer",
+	"fetch_total")
+#overhead of fetching in subprocess, see HTTPFetcher._doFetch()
+SUBPROCESS_PHASES = ("spawn", "pickle", "ipc", "body_read")
+#phases of metric computation, see metrics.Metric.distanceNormed()
+METRIC_PHASES = ("parse", "distance")
+
+def fetchPhases(timings):
+	"""Return durations of phases of one fetch.
+
+	@param timings: dict from HTTPFetcher.curlTimings(), possibly with
+	subprocess overhead times added by HTTPFetcher._doFetch()
+	@returns: dict mapping phase name to duration in seconds; TLS phase
+	is missing for plain HTTP, phases of connection setup are missing
+	for reused connections
+	"""
+	phases = {}
+	namelookup = timings.get("namelookup", 0.0)
+	connect = timings.get("connect", 0.0)
+	appconnect = timings.get("appconnect", 0.0)
+	starttransfer = timings.get("starttransfer", 0.0)
+	total = timings.get("total")
+
+	if connect > 0:
+		phases["dns"] = namelookup
+		phases["tcp_connect"] = max(0.0, connect - namelookup)
+	if appconnect > 0:
+		phases["tls_handshake"] = max(0.0, appconnect - connect)
+	if starttransfer > 0:
+		phases["server_wait"] = max(0.0, starttransfer - max(connect, appconnect))
+		if total is not None:
+			phases["transfer"] = max(0.0, total - starttransfer)
+	if total is not None:
+		phases["fetch_total"] = total
+	for phase in SUBPROCESS_PHASES:
+		if phase in timings:
+			phases[phase] = timings[phase]
+	return phases
+
+class Histogram(object):
+	"""Histogram of durations with logarithmic buckets."""
+
+	#upper bounds of buckets in seconds, last bucket is unbounded
+	bounds = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0,
+		10.0, 20.0, 60.0)
+
+	def __init__(self):
+		self.counts = [0] * (len(self.bounds) + 1)
+		self.count = 0
+		self.total = 0.0
+		self.maximum = 0.0
+
+	def add(self, duration):
+		self.counts[bisect.bisect_left(self.bounds, duration)] += 1
+		self.count += 1
+		self.total += duration
+		self.maximum = max(self.maximum, duration)
+
+	def quantile(self, fraction):
+		"""Return upper bound of bucket containing the quantile."""
+		rank = fraction * self.count
+		seen = 0
+		for (idx, count) in enumerate(self.counts):
+			seen += count
+			if seen >= rank and count:
+				return idx < len(self.bounds) and self.bounds[idx] or self.maximum
+		return self.maximum
+
+	def format(self):
+		"""Return one-line summary with non-empty buckets."""
+		buckets = []
+		for (idx, count) in enumerate(self.counts):
+			if not count:
+				continue
+			if idx < len(self.bounds):
+				label = "<=%gs" % self.bounds[idx]
+			else:
+				label = ">%gs" % self.bounds[-1]
+			buckets.append("%s:%d" % (label, count))
+		return "n=%d mean %.4fs p50<=%gs p95<=%gs max %.4fs [%s]" % (self.count,
+			self.total / self.count, self.quantile(0.5), self.quantile(0.95),
+			self.maximum, " ".join(buckets))
+
+class TimingHistograms(object):
+	"""Result sink aggregating durations of fetch, subprocess and metric
+	phases of all comparisons into histograms, reported at the end of
+	the run.
+	"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		#maps phase name to Histogram
+		self.histograms = {}
+
+	def add(self, phase, duration):
+		with self.lock:
+			histogram = self.histograms.get(phase)
+			if histogram is None:
+				histogram = self.histograms[phase] = Histogram()
+			histogram.add(duration)
+
+	def record(self, result):
+		"""Add timings of comparison result.
+
+		@param result: check_rules.ComparisonResult
+		"""
+		for chain in (result.plainChain, result.transformedChain):
+			for (url, httpCode, timings) in chain or ():
+				if not timings:
+					continue
+				for (phase, duration) in fetchPhases(timings).iteritems():
+					self.add(phase, duration)
+		for (phase, duration) in (result.metricTimings or {}).iteritems():
+			self.add(phase, duration)
+
+	def report(self):
+		"""Return list of lines with histogram of each phase."""
+		lines = []
+		with self.lock:
+			for phase in FETCH_PHASES + SUBPROCESS_PHASES + METRIC_PHASES:
+				histogram = self.histograms.get(phase)
+				if histogram:
+					lines.append("%s: %s" % (phase, histogram.format()))
+		return lines